@@ -0,0 +1,66 @@
+
+import numpy as np
+import hashlib
+import glob
+import os
+
+class CBoundaryCache:
+  # on disk cache of encoded boundaries. Entries are keyed by a hash of the
+  # geometry, the network checkpoint and the tile configuration and the 
+  # least recently used entries are removed when the total size is too big.
+
+  def __init__(self, config):
+    self.cache_dir = config.cboundary_cache_dir
+    if self.cache_dir == '':
+      self.cache_dir = config.latnet_network_dir + '/cboundary_cache'
+    self.max_size = config.cboundary_cache_size * 1000000
+    self.tile_config = [config.input_shape, config.input_cshape, 
+                        config.sim_shape, config.DxQy]
+
+  def enabled(self):
+    return self.max_size > 0
+
+  def key(self, geometry, checkpoint, padding_type):
+    sha = hashlib.sha1()
+    sha.update(np.ascontiguousarray(geometry).tobytes())
+    sha.update(str(geometry.shape) + str(geometry.dtype))
+    sha.update(str(checkpoint))
+    # a retrained network can save at the same step, so the checkpoint
+    # files themselves go in as well. The .index holds a checksum of every
+    # tensor, data files only add size and mtime
+    for file_name in sorted(glob.glob(checkpoint + '.*')):
+      stat = os.stat(file_name)
+      sha.update(os.path.basename(file_name) + str(stat.st_size) + str(stat.st_mtime))
+      if file_name.endswith('.index'):
+        with open(file_name, 'rb') as f:
+          sha.update(f.read())
+    sha.update(str(self.tile_config + padding_type))
+    return sha.hexdigest()
+
+  def key_to_filename(self, key):
+    return self.cache_dir + '/' + key + '.npy'
+
+  def load(self, key):
+    file_name = self.key_to_filename(key)
+    if not os.path.isfile(file_name):
+      return None
+    os.utime(file_name, None) # mark as recently used
+    return np.load(file_name)
+
+  def save(self, key, cboundary):
+    if not os.path.isdir(self.cache_dir):
+      os.makedirs(self.cache_dir)
+    file_name = self.key_to_filename(key)
+    np.save(file_name + '.tmp.npy', cboundary)
+    os.rename(file_name + '.tmp.npy', file_name)
+    self.evict()
+
+  def evict(self):
+    # remove least recently used entries until under max size
+    files = glob.glob(self.cache_dir + '/*.npy')
+    files = [f for f in files if not f.endswith('.tmp.npy')]
+    files.sort(key=os.path.getmtime)
+    total_size = sum([os.path.getsize(f) for f in files])
+    while total_size > self.max_size and len(files) > 1:
+      total_size -= os.path.getsize(files[0])
+      os.remove(files.pop(0))
@@ -67,10 +67,23 @@ class LatNetController(object):
                         default=0.95)
       group.add_argument('--l1_factor', help='all mode', type=float,
                         default=5.0)
+      group.add_argument('--gan_fused', help='train mode, gen and disc update in one session call', type=str2bool,
+                        default=False)
+      group.add_argument('--gan_disc_every', help='train mode, k for k:1 gen:disc updates', type=int,
+                        default=1)
       group.add_argument('--moving_average', help='all mode', type=str2bool,
                         default=True)
       group.add_argument('--train_iters', help='all mode', type=int,
                         default=500000)
+      group.add_argument('--input_staging', help='all mode', type=str2bool,
+                        default=False)
+      group.add_argument('--grad_reduce', help='train mode, how gradients of the gpus are summed', type=str,
+                        choices=['sum', 'tree', 'ring'],
+                        default='sum')
+      group.add_argument('--grad_bucket_size', help='train mode, gradients are sent in buckets of this many elements', type=int,
+                        default=0)
+      group.add_argument('--grad_fp16', help='train mode, send gradients between gpus as float16', type=str2bool,
+                        default=False)
 
       group = self._config_parser.add_group('Data Queue Details')
       group.add_argument('--train_sim_dir', help='train mode', type=str,
@@ -79,12 +92,28 @@ class LatNetController(object):
                         default=0.9)
       group.add_argument('--max_queue', help='all mode', type=int,
                         default=100)
+      group.add_argument('--use_state_store', help='train mode', type=str2bool,
+                        default=True)
+      group.add_argument('--data_workers', help='train mode, 0 uses threads', type=int,
+                        default=0)
+      group.add_argument('--gen_gpus', help='train mode, devices used to generate sailfish data', type=str,
+                        default='0')
+      group.add_argument('--gen_jobs_per_gpu', help='train mode, sailfish sims run at once per device', type=int,
+                        default=1)
+      group.add_argument('--gen_retries', help='train mode', type=int,
+                        default=2)
+      group.add_argument('--augment', help='train mode, random rotations and flips of train data', type=str2bool,
+                        default=False)
+      group.add_argument('--replay_capacity', help='train mode, max number of data points kept for sampling', type=int,
+                        default=4000)
+      group.add_argument('--priority_alpha', help='train mode, 0 samples data points uniformly', type=float,
+                        default=0.6)
 
       group = self._config_parser.add_group('Simulation Details')
       group.add_argument('--sim_shape', help='all mode', type=str,
                         default='512x512')
       group.add_argument('--DxQy', help='all mode', type=str,
-            choices=['D2Q9'], default='D2Q9')
+            choices=['D2Q9', 'D3Q15', 'D3Q19', 'D3Q27'], default='D2Q9')
       group.add_argument('--num_iters', help='eval mode', type=int,
                         default=15)
       group.add_argument('--sim_restore_iter', help='if 0 then it will not restore', type=int,
@@ -99,10 +128,32 @@ class LatNetController(object):
       group = self._config_parser.add_group('Simulation Process Details')
       group.add_argument('--compare', help='compares to sailfish simulation', type=str2bool,
                         default=True)
-      group.add_argument('--save_format', help='eval mode', type=str,
-                        default='npy')
+      group.add_argument('--save_format', help='eval mode, npy files, one chunked file for the run or vtk files', type=str,
+            choices=['npy', 'chunked', 'vtk'], default='npy')
       group.add_argument('--save_cstate', help='eval mode', type=str2bool,
                         default=False)
+      group.add_argument('--save_compressed', help='eval mode, only save cstate and decode when read', type=str2bool,
+                        default=False)
+      group.add_argument('--save_chunk', help='eval mode, chunk size for chunked save format', type=int,
+                        default=256)
+      group.add_argument('--save_precision', help='eval mode, float32, float16, quant16 or quant8 for chunked save format', type=str,
+                        default='float32')
+      group.add_argument('--eval_batch_size', help='eval mode, tiles per network call (0 is auto)', type=int,
+                        default=0)
+      group.add_argument('--eval_memory', help='eval mode, MB of device memory used for auto tile batching', type=int,
+                        default=2000)
+      group.add_argument('--eval_memory_factor', help='eval mode, device memory of a network call per byte of its input', type=int,
+                        default=64)
+      group.add_argument('--full_domain', help='eval mode, run compression mapping on the whole domain in one call', type=str2bool,
+                        default=False)
+      group.add_argument('--resident_state', help='eval mode, with full_domain keep cstate on device between saves', type=str2bool,
+                        default=False)
+      group.add_argument('--cboundary_cache_dir', help='eval mode, empty uses latnet_network_dir/cboundary_cache', type=str,
+                        default='')
+      group.add_argument('--cboundary_cache_size', help='eval mode, MB (0 disables)', type=int,
+                        default=0)
+      group.add_argument('--output_backlog', help='eval mode, saves decoded in background (0 disables)', type=int,
+                        default=2)
 
       # TODO this group will be removed when the sailfish configs are integrated
       group = self._config_parser.add_group('Sailfish Helper Details')
@@ -168,6 +219,7 @@ class LatNetController(object):
       self.trainer = self._trainer(self.config)
       self.trainer.init_network()
       self.trainer.make_data_queue()
+      self.trainer.init_session()
       self.trainer.train()
 
     def generate_data(self, config):
@@ -13,12 +13,16 @@ import psutil as ps
 import shutil
 from copy import copy
 from sailfish_simulation import TrainSailfishSimulation
+from sim_scheduler import SimScheduler
+from priority_sampler import PrioritySampler
 from utils.python_utils import *
 
-from Queue import Queue
+from collections import deque
+from Queue import Empty
 from shape_converter import SubDomain
 import lattice
 import threading
+import multiprocessing
 from utils.text_histogram import vector_to_text_hist
 
 class DataQueue:
@@ -28,8 +32,12 @@ class DataQueue:
     self.base_dir = config.train_sim_dir
     self.waiting_time = 0.0
     self.needed_to_wait = False
+    self.producer_waiting_time = 0.0
+    self.num_produced = 0
 
     # configs
+    self.config          = config
+    self.domains         = domains
     self.batch_size      = config.batch_size
     self.seq_length      = config.seq_length
     self.train_autoencoder = config.train_autoencoder
@@ -39,6 +47,7 @@ class DataQueue:
     self.gpus = map(int, gpus)
     self.DxQy = lattice.TYPES[config.DxQy]()
     self.input_cshape = str2shape(config.input_cshape)
+    self.num_workers     = config.data_workers
 
     # shape converter
     self.shape_converters = shape_converters
@@ -53,144 +62,344 @@ class DataQueue:
                             'true_cstate_' + str(self.seq_length-1) + gpu_str]
     self.cratio = pow(2, self.nr_downsamples)
 
-    # make queue
-    self.max_queue = config.max_queue
-    self.queue = Queue() # to stop halting when putting on the queue
-    self.queue_batches = []
+    # ring of preallocated batch buffers, workers write samples straight
+    # into free slots and minibatch hands out views of a filled batch
+    self.num_samples = self.batch_size*len(self.gpus)
+    self.num_batch_buffers = max(2, config.max_queue/self.num_samples)
+    self.max_queue = self.num_batch_buffers*self.num_samples
+    self.current_batch = 0
+    self.released_batch = None
+    self.filled_counts = self.num_batch_buffers*[0]
 
-    # generate base dataset and start queues
+    # data points are drawn by loss priority, the sampler leaf and its
+    # generation are kept for every slot so the trainer can update 
+    # priorities after a step
+    self.sampler = PrioritySampler(config.replay_capacity, config.priority_alpha)
+    self.slot_leaves = np.zeros(self.max_queue, dtype=np.int64)
+    self.slot_generations = np.zeros(self.max_queue, dtype=np.int64)
+    self.batch_ids = None
+    self.domain_losses = {}
+
+    # simulations are added as soon as their data is ready, missing ones 
+    # are generated in parallel while training runs
     self.sim_runners = []
-    for domain in domains:
-      print("generating " + domain.name + " dataset")
-      start_num_data_points = 1000/(len(domains)*domain.num_simulations)
+    self.sim_lock = threading.Lock()
+    self.sim_added = threading.Condition(self.sim_lock)
+    self.started = False
+    self.scheduler = SimScheduler(config)
+    for domain_index, domain in enumerate(domains):
+      print("checking " + domain.name + " dataset")
       for i in tqdm(xrange(domain.num_simulations)):
         sim = TrainSailfishSimulation(config, domain, self.base_dir + '/sim_' + domain.name + '_' + str(i).zfill(4))
+        sim.domain_index = domain_index
         if sim.need_to_generate():
-          sim.generate_train_data()
-        sim.make_rand_data_points(start_num_data_points, 
-                                 seq_length=self.seq_length,
-                                 state_shape_converter=self.state_shape_converter, 
-                                 seq_state_shape_converter=self.seq_state_shape_converter,
-                                 input_cshape=self.input_cshape,
-                                 cratio=self.cratio)
-        self.sim_runners.append(sim)
-        thr = threading.Thread(target= (lambda: self.data_worker(sim)))
-        thr.daemon = True
-        thr.start()
-
-  def data_worker(self, sim):
+          self.scheduler.add(sim, self.add_sim, self.gen_job_done)
+        else:
+          self.add_sim(sim)
+    self.scheduler.start()
+
+    # wait for the first simulation, add_sim appends before its job is
+    # marked done so both are checked under the lock
+    with self.sim_added:
+      while len(self.sim_runners) == 0:
+        if self.scheduler.jobs.unfinished_tasks == 0:
+          raise RuntimeError("no training simulations could be generated")
+        self.sim_added.wait()
+
+    # shapes of the slots are taken from one sample
+    self.sample_slots = SampleSlots(self.sim_runners[0].read_train_data(),
+                                    self.max_queue, shared=(self.num_workers > 0))
+
+    # start workers, processes are forked with no lock held and get the
+    # simulations added during the fork sent after it
+    if self.num_workers > 0:
+      num_forked_sims = len(self.sim_runners)
+      self.start_data_processes()
+    with self.sim_lock:
+      if self.num_workers > 0:
+        for sim_index in xrange(num_forked_sims, len(self.sim_runners)):
+          self.send_process_sim(sim_index)
+      else:
+        self.start_data_threads()
+      self.started = True
+
+  def add_sim(self, sim):
+    if sim.use_state_store:
+      sim.make_state_store()
+    domain = self.domains[sim.domain_index]
+    sim.make_rand_data_points(1000/(len(self.domains)*domain.num_simulations), 
+                             seq_length=self.seq_length,
+                             state_shape_converter=self.state_shape_converter, 
+                             seq_state_shape_converter=self.seq_state_shape_converter,
+                             input_cshape=self.input_cshape,
+                             cratio=self.cratio)
+    with self.sim_lock:
+      sim_index = len(self.sim_runners)
+      self.sim_runners.append(sim)
+      self.sim_added.notify_all()
+      if self.started and self.num_workers > 0:
+        self.send_process_sim(sim_index)
+      elif self.started:
+        self.start_data_thread()
+    for data_point in sim.data_points:
+      self.sampler.add((sim_index, data_point))
+
+  def gen_job_done(self):
+    # wakes the wait for the first simulation when a job fails
+    with self.sim_added:
+      self.sim_added.notify_all()
+
+  def start_data_threads(self):
+    self.free_slots = deque(xrange(self.max_queue))
+    self.queue_cond = threading.Condition()
+    for sim in self.sim_runners:
+      self.start_data_thread()
+
+  def start_data_thread(self):
+    thr = threading.Thread(target=self.data_worker)
+    thr.daemon = True
+    thr.start()
+
+  def start_data_processes(self):
+    # only slot indices and data points go through the queues, the data
+    # is in shared memory
+    self.free_slots = multiprocessing.Queue()
+    self.filled_slots = multiprocessing.Queue()
+    for i in xrange(self.max_queue):
+      self.request_slot(i)
+
+    # new simulations are sent to every process
+    self.sim_queues = []
+    for i in xrange(self.num_workers):
+      self.sim_queues.append(multiprocessing.Queue())
+    for sim_queue in self.sim_queues:
+      proc = multiprocessing.Process(target=self.data_process_worker, args=(sim_queue,))
+      proc.daemon = True
+      proc.start()
+
+  def send_process_sim(self, sim_index):
+    sim = self.sim_runners[sim_index]
+    for sim_queue in self.sim_queues:
+      sim_queue.put((sim_index, sim.domain_index, sim.save_dir))
+
+  def request_slot(self, slot):
+    # processes can not see the sampler so the data point is drawn here
+    leaf, generation, (sim_index, data_point) = self.sampler.sample()
+    self.slot_leaves[slot] = leaf
+    self.slot_generations[slot] = generation
+    self.free_slots.put((slot, sim_index, data_point))
+
+  def add_process_sim(self, message):
+    # a simulation can be sent to a process that already has it from the fork
+    sim_index, domain_index, save_dir = message
+    if sim_index < len(self.sim_runners):
+      return
+    sim = TrainSailfishSimulation(self.config, self.domains[domain_index], save_dir)
+    if sim.use_state_store:
+      sim.open_state_store()
+    self.sim_runners.append(sim)
+
+  def data_process_worker(self, sim_queue):
+    np.random.seed()
     while True:
-      self.queue.get()
-
-      # get geometry and lat data
-      state, geometry, seq_state = sim.read_train_data()
-
-      # add to que
-      self.queue_batches.append((state, geometry, seq_state))
-      self.queue.task_done()
-
-  def rand_data_point(self):
-    sim_index = np.random.randint(0, len(self.sim_runners))
-    data_point = self.sim_runners[sim_index].rand_data_point(
-                                 seq_length=self.seq_length,
-                                 state_shape_converter=self.state_shape_converter, 
-                                 seq_state_shape_converter=self.seq_state_shape_converter,
-                                 input_cshape=self.input_cshape,
-                                 cratio=self.cratio)
-    state, geometry, seq_state = self.sim_runners[sim_index].data_point_to_data(data_point, add_batch=True)
-
-    # make feed dict
-    feed_dict = {}
-    gpu_str = '_gpu_' + str(self.gpus[0])
-    feed_dict['state' + gpu_str] = state
-    feed_dict['boundary' + gpu_str] = geometry
-    for j in xrange(self.seq_length):
-      feed_dict['true_state_' + str(j) + gpu_str] = seq_state[j]
+      # add new simulations
+      while not sim_queue.empty():
+        self.add_process_sim(sim_queue.get())
+
+      # wait for a free slot
+      slot, sim_index, data_point = self.free_slots.get()
+
+      # the simulation may still be on its way
+      while sim_index >= len(self.sim_runners):
+        self.add_process_sim(sim_queue.get())
 
-    return sim_index, data_point, feed_dict
+      # read sample straight into the slot, a failed read is sent back so 
+      # the slot gets a new data point
+      sim = self.sim_runners[sim_index]
+      try:
+        self.sample_slots.write(slot, sim.read_train_data(data_point))
+        self.filled_slots.put((slot, True))
+      except Exception as e:
+        print("reading train data from " + sim.save_dir + " failed with " + str(e))
+        self.filled_slots.put((slot, False))
 
-  def add_data_point(self, sim_index, data_point):
-    self.sim_runners[sim_index].add_data_point(data_point)
+  def data_worker(self):
+    while True:
+      # wait for a free slot
+      with self.queue_cond:
+        tic = time.time()
+        while len(self.free_slots) == 0:
+          self.queue_cond.wait()
+        self.producer_waiting_time += time.time() - tic
+        slot = self.free_slots.popleft()
+
+      # draw data point and read it straight into the slot, if the read
+      # fails the slot is handed back so its batch can still fill
+      leaf, generation, (sim_index, data_point) = self.sampler.sample()
+      self.slot_leaves[slot] = leaf
+      self.slot_generations[slot] = generation
+      sim = self.sim_runners[sim_index]
+      try:
+        self.sample_slots.write(slot, sim.read_train_data(data_point))
+      except Exception as e:
+        print("reading train data from " + sim.save_dir + " failed with " + str(e))
+        with self.queue_cond:
+          self.free_slots.appendleft(slot)
+          self.queue_cond.notify_all()
+        continue
+
+      # mark slot filled
+      with self.queue_cond:
+        self.filled_counts[slot/self.num_samples] += 1
+        self.num_produced += 1
+        self.queue_cond.notify_all()
+
+  def add_rand_data_points(self, num_points):
+    # fresh points go in with max priority and push out the easiest ones
+    for i in xrange(num_points):
+      sim_index = np.random.randint(0, len(self.sim_runners))
+      data_point = self.sim_runners[sim_index].rand_data_point(
+                                   seq_length=self.seq_length,
+                                   state_shape_converter=self.state_shape_converter, 
+                                   seq_state_shape_converter=self.seq_state_shape_converter,
+                                   input_cshape=self.input_cshape,
+                                   cratio=self.cratio)
+      self.sampler.add((sim_index, data_point))
+
+  def update_priorities(self, batch_ids, losses):
+    # batch_ids are the (leaves, generations) of a batch
+    leaves, generations = batch_ids
+    updated = self.sampler.update(leaves, generations, losses)
+
+    # running average of the per sample loss of every domain
+    for (sim_index, _), loss in updated:
+      name = self.domains[self.sim_runners[sim_index].domain_index].name
+      ave_loss = self.domain_losses.get(name, float(loss))
+      self.domain_losses[name] = 0.99*ave_loss + 0.01*float(loss)
  
   def minibatch(self):
+    # returned arrays are views into the batch ring and stay valid until
+    # the next call to minibatch
+
+    # hand the previously returned batch back to the workers
+    batch = self.current_batch
+    if self.released_batch is not None:
+      slots = xrange(self.released_batch*self.num_samples, (self.released_batch+1)*self.num_samples)
+      if self.num_workers > 0:
+        for slot in slots:
+          self.request_slot(slot)
+      else:
+        with self.queue_cond:
+          self.free_slots.extend(slots)
+          self.queue_cond.notify_all()
 
-    # queue up data if needed
-    for i in xrange(self.max_queue - len(self.queue_batches) - self.queue.qsize()):
-      self.queue.put(None)
-   
     # possibly wait if data needs time to queue up
-    while len(self.queue_batches) < 2*self.batch_size*len(self.gpus): # added times two to make sure enough
-      self.waiting_time += 1.0
-      self.needed_to_wait = True
-      time.sleep(1.0)
-
-    # generate batch of data in the form of a feed dict
-    batch_state = []
-    batch_pad_state = []
-    batch_geometry = []
-    batch_pad_geometry = []
-    batch_seq_state = []
-    batch_pad_seq_state = []
-    for i in xrange(self.batch_size*len(self.gpus)): 
-      batch_state.append(self.queue_batches[0][0][0])
-      batch_pad_state.append(self.queue_batches[0][0][1])
-      batch_geometry.append(self.queue_batches[0][1][0])
-      batch_pad_geometry.append(self.queue_batches[0][1][1])
-      batch_seq_state.append([x[0] for x in self.queue_batches[0][2]])
-      batch_pad_seq_state.append([x[1] for x in self.queue_batches[0][2]])
-      self.queue_batches.pop(0)
-
-    # concate batches together
-    batch_state = np.stack(batch_state, axis=0)
-    batch_pad_state = np.stack(batch_pad_state, axis=0)
-    batch_geometry = np.stack(batch_geometry, axis=0)
-    batch_pad_geometry = np.stack(batch_pad_geometry, axis=0)
-    new_batch_seq_state = []
-    new_batch_pad_seq_state = []
-    for i in xrange(self.seq_length):
-      new_batch_seq_state.append(np.stack([x[i] for x in batch_seq_state], axis=0))
-      new_batch_pad_seq_state.append(np.stack([x[i] for x in batch_pad_seq_state], axis=0))
-    batch_seq_state = new_batch_seq_state
-    batch_pad_seq_state = new_batch_pad_seq_state
-
-    # make feed dict
+    tic = time.time()
+    if self.num_workers > 0:
+      # count what is already filled and only block if that is not enough
+      self.drain_filled_slots()
+      while self.filled_counts[batch] < self.num_samples:
+        self.needed_to_wait = True
+        self.count_filled_slot(*self.filled_slots.get())
+    else:
+      with self.queue_cond:
+        while self.filled_counts[batch] < self.num_samples:
+          self.needed_to_wait = True
+          self.queue_cond.wait()
+    self.waiting_time += time.time() - tic
+    self.filled_counts[batch] = 0
+    self.released_batch = batch
+    self.current_batch = (batch + 1) % self.num_batch_buffers
+    batch_slots = slice(batch*self.num_samples, (batch+1)*self.num_samples)
+    self.batch_ids = (self.slot_leaves[batch_slots].copy(), self.slot_generations[batch_slots].copy())
+
+    # batch of data, no copies
+    (batch_state, batch_pad_state), (batch_geometry, batch_pad_geometry), batch_seq_state = (
+        self.sample_slots.read(slice(batch*self.num_samples, (batch+1)*self.num_samples)))
+
+    # make feed dict with per gpu views
     feed_dict = {}
     for i in xrange(len(self.gpus)):
       gpu_str = '_gpu_' + str(self.gpus[i])
-      feed_dict['state' + gpu_str] = (batch_state[i*self.batch_size:(i+1)*self.batch_size],
-                                      batch_pad_state[i*self.batch_size:(i+1)*self.batch_size])
-      feed_dict['boundary' + gpu_str] = (batch_geometry[i*self.batch_size:(i+1)*self.batch_size],
-                                         batch_pad_geometry[i*self.batch_size:(i+1)*self.batch_size])
+      gpu_slice = slice(i*self.batch_size, (i+1)*self.batch_size)
+      feed_dict['state' + gpu_str] = (batch_state[gpu_slice], batch_pad_state[gpu_slice])
+      feed_dict['boundary' + gpu_str] = (batch_geometry[gpu_slice], batch_pad_geometry[gpu_slice])
       for j in xrange(self.seq_length):
-        feed_dict['true_state_' + str(j) + gpu_str] = (batch_seq_state[j][i*self.batch_size:(i+1)*self.batch_size],
-                            batch_pad_seq_state[j][i*self.batch_size:(i+1)*self.batch_size])
+        feed_dict['true_state_' + str(j) + gpu_str] = (batch_seq_state[j][0][gpu_slice],
+                                                       batch_seq_state[j][1][gpu_slice])
 
     return feed_dict
 
+  def drain_filled_slots(self):
+    while True:
+      try:
+        slot, filled = self.filled_slots.get_nowait()
+      except Empty:
+        return
+      self.count_filled_slot(slot, filled)
+
+  def count_filled_slot(self, slot, filled):
+    if filled:
+      self.filled_counts[slot/self.num_samples] += 1
+    else:
+      self.request_slot(slot)
+
   def num_data_points(self):
-    num_points = 0
-    for i in xrange(len(self.sim_runners)):
-      num_points += len(self.sim_runners[i].data_points)
-    return num_points
+    return self.sampler.num_items
 
   def ind_histogram(self):
-    inds = []
-    for i in xrange(len(self.sim_runners)):
-      for j in xrange(len(self.sim_runners[i].data_points)):
-        inds.append(self.sim_runners[i].data_points[j].ind)
-    inds = np.array(inds)
+    inds = np.array([data_point.ind for _, data_point in self.sampler.stored_items()])
     return vector_to_text_hist(inds, bins=10)
 
   def queue_stats(self):
     stats = {}
-    stats['percent full'] = int(100*float(len(self.queue_batches))/float(self.max_queue))
-    stats['total_wait_time'] = int(self.waiting_time)
+    if self.num_workers > 0:
+      self.drain_filled_slots()
+    stats['percent full'] = int(100*float(sum(self.filled_counts))/float(self.max_queue))
+    stats['total_wait_time'] = self.waiting_time
+    if self.num_workers == 0:
+      stats['producer_wait_time'] = self.producer_waiting_time
+      stats['samples_produced'] = self.num_produced
     stats['queue_waited'] = self.needed_to_wait
+    stats['input_shape'] = self.sample_slots.shapes[0]
+    stats['output_shape'] = self.sample_slots.shapes[4]
+    self.needed_to_wait = False
     stats['num_data_points'] = self.num_data_points()
     stats['ind_histogram'] = self.ind_histogram()
-    if len(self.queue_batches) > 1:
-      stats['input_shape'] = self.queue_batches[0][0][0].shape
-      stats['output_shape'] = self.queue_batches[0][2][0][0].shape
-    self.needed_to_wait = False
+    for name in self.domain_losses.keys():
+      stats['loss_' + name] = self.domain_losses[name]
     return stats
 
+class SampleSlots:
+  # preallocated float32 slots for samples, laid out so that a run of
+  # consecutive slots is a zero copy batch. With shared=True the slots live
+  # in shared memory so worker processes can hand back data without
+  # pickling arrays. A sample is the
+  # ((state, pad_state), (geometry, pad_geometry), [(seq_state, pad_seq_state), ...])
+  # tuple returned by read_train_data.
+
+  def __init__(self, sample, num_slots, shared=False):
+    self.shapes = [x.shape for x in self.flatten(sample)]
+    self.arrays = []
+    for shape in self.shapes:
+      if shared:
+        raw = multiprocessing.RawArray('f', num_slots*int(np.prod(shape)))
+        self.arrays.append(np.frombuffer(raw, dtype=np.float32).reshape((num_slots,) + shape))
+      else:
+        self.arrays.append(np.zeros((num_slots,) + shape, dtype=np.float32))
+
+  def flatten(self, sample):
+    flat = [sample[0][0], sample[0][1], sample[1][0], sample[1][1]]
+    for x in sample[2]:
+      flat += [x[0], x[1]]
+    return flat
+
+  def write(self, slot, sample):
+    for array, x in zip(self.arrays, self.flatten(sample)):
+      array[slot] = x
+
+  def read(self, slot):
+    # slot can be an index or a slice of slots
+    flat = [array[slot] for array in self.arrays]
+    seq = [(flat[i], flat[i+1]) for i in xrange(4, len(flat), 2)]
+    return ((flat[0], flat[1]), (flat[2], flat[3]), seq)
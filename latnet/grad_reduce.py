@@ -0,0 +1,127 @@
+
+import tensorflow as tf
+
+# cross tower gradient reduction. Every method takes one flat tensor per
+# device and returns the sum on every device, ops only needed on other
+# devices are pruned by tensorflow if only the first copy is used.
+# Devices are plain device strings so it also runs on cpu devices, e.g.
+# '/cpu:0', '/cpu:1' with tf.ConfigProto(device_count={'CPU': 2}).
+
+def all_reduce(tower_grads, devices, method='sum', bucket_size=0, fp16=False):
+  # tower_grads is a list of gradient lists, one per device, None entries
+  # stay None. Gradients are flattened into buckets of up to bucket_size
+  # elements so small tensors are sent together, with fp16 everything
+  # crosses devices as float16 and is summed in float32.
+  num_grads = len(tower_grads[0])
+  inds = [j for j in xrange(num_grads) if tower_grads[0][j] is not None]
+  sizes = [tower_grads[0][j].get_shape().num_elements() for j in inds]
+  reduced = [num_grads*[None] for device in devices]
+  for bucket in make_buckets(sizes, bucket_size):
+    # flatten bucket on every device
+    flat = []
+    for i in xrange(len(devices)):
+      with tf.device(devices[i]):
+        flat.append(tf.concat([tf.reshape(tower_grads[i][inds[k]], [-1]) for k in bucket], axis=0))
+
+    # reduce
+    flat = REDUCTIONS[method](flat, devices, fp16)
+
+    # split back into gradients
+    for i in xrange(len(devices)):
+      with tf.device(devices[i]):
+        parts = tf.split(flat[i], [sizes[k] for k in bucket])
+        for k, part in zip(bucket, parts):
+          reduced[i][inds[k]] = tf.reshape(part, tower_grads[i][inds[k]].get_shape())
+  return reduced
+
+def make_buckets(sizes, bucket_size):
+  # groups consecutive indices while their total size fits in bucket_size
+  buckets = []
+  bucket = []
+  total = 0
+  for k in xrange(len(sizes)):
+    if len(bucket) > 0 and total + sizes[k] > bucket_size:
+      buckets.append(bucket)
+      bucket = []
+      total = 0
+    bucket.append(k)
+    total += sizes[k]
+  if len(bucket) > 0:
+    buckets.append(bucket)
+  return buckets
+
+def send(x, src, dst, fp16=False):
+  # x as seen on dst, possibly sent as float16
+  if fp16:
+    with tf.device(src):
+      x = tf.cast(x, tf.float16)
+  with tf.device(dst):
+    if fp16:
+      return tf.cast(x, tf.float32)
+    return tf.identity(x)
+
+def broadcast(x, devices, fp16=False):
+  # x lives on the first device
+  return [x] + [send(x, devices[0], device, fp16) for device in devices[1:]]
+
+def sum_reduce(flat, devices, fp16=False):
+  # every device sends to the first one
+  with tf.device(devices[0]):
+    total = flat[0]
+    for i in xrange(1, len(devices)):
+      total += send(flat[i], devices[i], devices[0], fp16)
+  return broadcast(total, devices, fp16)
+
+def tree_reduce(flat, devices, fp16=False):
+  # pairwise sums, log2(num devices) levels with the result on the first
+  flat = list(flat)
+  stride = 1
+  while stride < len(devices):
+    for i in xrange(0, len(devices) - stride, 2*stride):
+      with tf.device(devices[i]):
+        flat[i] = flat[i] + send(flat[i+stride], devices[i+stride], devices[i], fp16)
+    stride *= 2
+  return broadcast(flat[0], devices, fp16)
+
+def ring_reduce(flat, devices, fp16=False):
+  # reduce scatter then all gather around the ring, every device only
+  # sends 2*(n-1)/n of the data to its neighbour
+  n = len(devices)
+  if n == 1:
+    return flat
+  size = flat[0].get_shape().num_elements()
+  chunk_sizes = [size/n + (1 if k < size % n else 0) for k in xrange(n)]
+  chunks = []
+  for i in xrange(n):
+    with tf.device(devices[i]):
+      chunks.append(tf.split(flat[i], chunk_sizes))
+
+  # reduce scatter, after it device i holds the sum of chunk (i+1)%n
+  for step in xrange(n-1):
+    new_chunks = [list(c) for c in chunks]
+    for i in xrange(n):
+      k = (i - step) % n
+      dst = (i + 1) % n
+      with tf.device(devices[dst]):
+        new_chunks[dst][k] = chunks[dst][k] + send(chunks[i][k], devices[i], devices[dst], fp16)
+    chunks = new_chunks
+
+  # all gather
+  for step in xrange(n-1):
+    new_chunks = [list(c) for c in chunks]
+    for i in xrange(n):
+      k = (i + 1 - step) % n
+      dst = (i + 1) % n
+      new_chunks[dst][k] = send(chunks[i][k], devices[i], devices[dst], fp16)
+    chunks = new_chunks
+
+  flat = []
+  for i in xrange(n):
+    with tf.device(devices[i]):
+      flat.append(tf.concat(chunks[i], axis=0))
+  return flat
+
+REDUCTIONS = {'sum':  sum_reduce,
+              'tree': tree_reduce,
+              'ring': ring_reduce}
+
@@ -5,6 +5,7 @@ from copy import copy
 import os
 from termcolor import colored, cprint
 import tensorflow as tf
+from tensorflow.python.ops.data_flow_ops import StagingArea
 import numpy as np
 
 import lattice
@@ -14,6 +15,7 @@ from shape_converter import ShapeConverter
 from optimizer import Optimizer
 from shape_converter import SubDomain
 from network_saver import NetworkSaver
+from grad_reduce import all_reduce
 
 class LatNet(object):
   # default network name
@@ -37,6 +39,11 @@ class LatNet(object):
     self.train_autoencoder = config.train_autoencoder
     self.gan = config.gan
     self.train_iters = config.train_iters
+    self.input_staging = config.input_staging
+    self.staged_names = []
+    # a staged batch is dequeued by the gen step so the disc step has to
+    # run in the same session call to see the same batch
+    self.gan_fused = config.gan_fused or config.input_staging
     gpus = config.gpus.split(',')
     self.gpus = map(int, gpus)
     self.loss_stats = {}
@@ -80,19 +87,24 @@ class LatNet(object):
         with tf.device('/gpu:%d' % self.gpus[i]):
           # make input state and boundary
           self.add_tensor('state' + gpu_str, (1 + self.DxQy.dims) * [None] + [self.DxQy.Q])
-          self.add_tensor('boundary' + gpu_str, (1 + self.DxQy.dims) * [None] + [6])
-          self.add_tensor('boundary_small' + gpu_str, (1 + self.DxQy.dims) * [None] + [6])
+          self.add_tensor('boundary' + gpu_str, (1 + self.DxQy.dims) * [None] + [2*self.DxQy.dims + 2])
+          self.add_tensor('boundary_small' + gpu_str, (1 + self.DxQy.dims) * [None] + [2*self.DxQy.dims + 2])
           self.add_phase() 
+          # make seq of output states
+          for j in xrange(self.seq_length):
+            self.add_tensor('true_state' + seq_str(j), (1 + self.DxQy.dims) * [None] + [self.DxQy.Q])
+
+          # possibly stage inputs on the gpu so copies overlap the previous step
+          if self.input_staging:
+            self.add_staging_area(['state' + gpu_str, 'boundary' + gpu_str]
+                                + ['true_state' + seq_str(j) for j in xrange(self.seq_length)],
+                                  stage_name='stage' + gpu_str)
+
           if i == 0:
             with tf.device('/cpu:0'):
               self.lattice_summary(in_name='state' + gpu_str, summary_name='true')
               self.boundary_summary(in_name='boundary' + gpu_str, summary_name='boundary')
-          # make seq of output states
-          for j in xrange(self.seq_length):
-            self.add_tensor('true_state' + seq_str(j), (1 + self.DxQy.dims) * [None] + [self.DxQy.Q])
-            self.out_tensors["true_state" + seq_str(j)] = self.out_tensors["true_state" + seq_str(j)]
-            if i == 0:
-              with tf.device('/cpu:0'):
+              for j in xrange(self.seq_length):
                 self.lattice_summary(in_name='true_state' + seq_str(j), summary_name='true_' + str(j))
       
           ###### Unroll Graph ######
@@ -179,15 +191,11 @@ class LatNet(object):
 
           ### L2 loss ###
           if not self.gan:
-            self.out_tensors["loss_comp_l2" + gpu_str] = 0.0
-
             # factor to account for how much the sim is changing
             seq_factor = tf.nn.l2_loss(self.out_tensors['true_state' + seq_str(0)]
                                      - self.out_tensors['true_state' + seq_str(self.seq_length-1)])
             if self.train_autoencoder:
 
-              self.out_tensors["loss_auto_l2" + gpu_str] = 0.0
-
               for j in range(0, self.seq_length):
                 # normalize loss to make comparable for diffrent input sizes
                 # TODO remove 100.0 (only in to make comparable to previous code)
@@ -204,8 +212,8 @@ class LatNet(object):
                              loss_name='loss_comp_l2' + seq_str(j),
                              factor=l2_factor/1.0)
                 # add up losses
-                self.out_tensors['loss_auto_l2' + gpu_str] += self.out_tensors['loss_auto_l2' + seq_str(j)] 
-                self.out_tensors['loss_comp_l2' + gpu_str] += self.out_tensors['loss_comp_l2' + seq_str(j)] 
+                self.add_loss('loss_auto_l2' + gpu_str, 'loss_auto_l2' + seq_str(j))
+                self.add_loss('loss_comp_l2' + gpu_str, 'loss_comp_l2' + seq_str(j))
             else:
               for j in range(1, self.seq_length):
                 # normalize loss to make comparable for diffrent input sizes
@@ -217,13 +225,12 @@ class LatNet(object):
                              factor=l2_factor/1.0)
                              #factor=l2_factor/num_samples)
                 # add up losses
-                self.out_tensors['loss_comp_l2' + gpu_str] += self.out_tensors['loss_comp_l2' + seq_str(j)] 
+                self.add_loss('loss_comp_l2' + gpu_str, 'loss_comp_l2' + seq_str(j))
  
 
 
           ### L1 loss ###
           if self.gan:
-            self.out_tensors["loss_l1" + gpu_str] = 0.0
             for j in range(1, self.seq_length):
               l1_factor = self.config.l1_factor
               self.l1_loss(true_name='true_state' + seq_str(j),
@@ -231,24 +238,28 @@ class LatNet(object):
                            loss_name='loss_l1' + seq_str(j),
                            factor=l1_factor/len(self.gpus))
               # add up losses
-              self.out_tensors['loss_l1' + gpu_str] += self.out_tensors['loss_l1' + seq_str(j)] 
+              self.add_loss('loss_l1' + gpu_str, 'loss_l1' + seq_str(j))
           ### Unconditional GAN loss ###
           if self.gan:
             # normal gan losses
+            # the unconditional discriminator sees the seq stacked on the batch
             self.gen_loss(class_name='D_un_class_pred' + gpu_str,
                           loss_name='loss_gen_un_class' + gpu_str,
-                          factor=1.0/len(self.gpus))
+                          factor=1.0/len(self.gpus),
+                          num_seq=self.seq_length-1)
             self.disc_loss(true_class_name='D_un_class_true' + gpu_str,
                            pred_class_name='D_un_class_pred' + gpu_str,
                            loss_name='loss_disc_un_class' + gpu_str,
-                           factor=1.0/len(self.gpus))
+                           factor=1.0/len(self.gpus),
+                           num_seq=self.seq_length-1)
             # layer loss as seen in tempoGAN: A Temporally Coherent, Volumetric GAN for
             # Super-resolution Fluid Flow
             l2_layer_factor = 1e-5 # from paper TODO make config param
             self.l2_loss(true_name='D_un_layer_true' + gpu_str,
                          pred_name='D_un_layer_pred' + gpu_str,
                          loss_name='loss_layer_l2' + gpu_str,
-                         factor=l2_layer_factor/len(self.gpus))
+                         factor=l2_layer_factor/len(self.gpus),
+                         num_seq=self.seq_length-1)
 
           ### Conditional GAN loss ###
           if self.gan:
@@ -262,18 +273,17 @@ class LatNet(object):
                            factor=1.0/len(self.gpus))
 
           #### add all losses together ###
-          self.out_tensors['loss_gen' + gpu_str] =  0.0
           if not self.gan:
             if self.train_autoencoder:
-              self.out_tensors['loss_gen' + gpu_str] += self.out_tensors['loss_auto_l2' + gpu_str]
-            self.out_tensors['loss_gen' + gpu_str] += self.out_tensors['loss_comp_l2' + gpu_str]
+              self.add_loss('loss_gen' + gpu_str, 'loss_auto_l2' + gpu_str)
+            self.add_loss('loss_gen' + gpu_str, 'loss_comp_l2' + gpu_str)
           if self.gan:
-            self.out_tensors['loss_gen' + gpu_str] += self.out_tensors['loss_l1' + gpu_str]
-            self.out_tensors['loss_gen' + gpu_str] += self.out_tensors['loss_gen_un_class' + gpu_str]
-            self.out_tensors['loss_gen' + gpu_str] += self.out_tensors['loss_gen_con_class' + gpu_str]
-            self.out_tensors['loss_gen' + gpu_str] += self.out_tensors['loss_layer_l2' + gpu_str]
-            self.out_tensors['loss_disc' + gpu_str] = self.out_tensors['loss_disc_un_class' + gpu_str]
-            self.out_tensors['loss_disc' + gpu_str] += self.out_tensors['loss_disc_con_class' + gpu_str]
+            self.add_loss('loss_gen' + gpu_str, 'loss_l1' + gpu_str)
+            self.add_loss('loss_gen' + gpu_str, 'loss_gen_un_class' + gpu_str)
+            self.add_loss('loss_gen' + gpu_str, 'loss_gen_con_class' + gpu_str)
+            self.add_loss('loss_gen' + gpu_str, 'loss_layer_l2' + gpu_str)
+            self.add_loss('loss_disc' + gpu_str, 'loss_disc_un_class' + gpu_str)
+            self.add_loss('loss_disc' + gpu_str, 'loss_disc_con_class' + gpu_str)
  
           ###### Grad Operation ######
           if i == 0:
@@ -288,48 +298,35 @@ class LatNet(object):
 
       ###### Round up losses and Gradients on gpu:0 ######
       ### Round up losses ###
-      with tf.device('/gpu:%d' % self.gpus[0]):
-        gpu_str = lambda x: '_gpu_' + str(self.gpus[x])
-        for i in range(1, len(self.gpus)):
-          self.out_tensors['loss_gen' + gpu_str(0)] += self.out_tensors['loss_gen' + gpu_str(i)]
-          if not self.gan:
-            if self.train_autoencoder:
-              self.out_tensors['loss_auto_l2' + gpu_str(0)] += self.out_tensors['loss_auto_l2' + gpu_str(i)]
-            self.out_tensors['loss_comp_l2' + gpu_str(0)] += self.out_tensors['loss_comp_l2' + gpu_str(i)]
-          if self.gan:
-            self.out_tensors['loss_l1' + gpu_str(0)] += self.out_tensors['loss_l1' + gpu_str(i)]
-            self.out_tensors['loss_gen_un_class' + gpu_str(0)] += self.out_tensors['loss_gen_un_class' + gpu_str(i)]
-            self.out_tensors['loss_gen_con_class' + gpu_str(0)] += self.out_tensors['loss_gen_con_class' + gpu_str(i)]
-            self.out_tensors['loss_layer_l2' + gpu_str(0)] += self.out_tensors['loss_layer_l2' + gpu_str(i)]
-            self.out_tensors['loss_disc_un_class' + gpu_str(0)] += self.out_tensors['loss_disc_un_class' + gpu_str(i)]
-            self.out_tensors['loss_disc_con_class' + gpu_str(0)] += self.out_tensors['loss_disc_con_class' + gpu_str(i)]
-            self.out_tensors['loss_disc' + gpu_str(0)] += self.out_tensors['loss_disc' + gpu_str(i)]
-      self.rename_tensor(old_name='loss_gen' + gpu_str(0), new_name='loss_gen')
+      loss_names = ['loss_gen']
       if not self.gan:
         if self.train_autoencoder:
-          self.rename_tensor(old_name='loss_auto_l2' + gpu_str(0), new_name='loss_auto_l2')
-        self.rename_tensor(old_name='loss_comp_l2' + gpu_str(0), new_name='loss_comp_l2')
+          loss_names.append('loss_auto_l2')
+        loss_names.append('loss_comp_l2')
       if self.gan:
-        self.rename_tensor(old_name='loss_l1' + gpu_str(0), new_name='loss_l1')
-        self.rename_tensor(old_name='loss_gen_un_class' + gpu_str(0), new_name='loss_gen_un_class')
-        self.rename_tensor(old_name='loss_gen_con_class' + gpu_str(0), new_name='loss_gen_con_class')
-        self.rename_tensor(old_name='loss_layer_l2' + gpu_str(0), new_name='loss_layer_l2')
-        self.rename_tensor(old_name='loss_disc_un_class' + gpu_str(0), new_name='loss_disc_un_class')
-        self.rename_tensor(old_name='loss_disc_con_class' + gpu_str(0), new_name='loss_disc_con_class')
-        self.rename_tensor(old_name='loss_disc' + gpu_str(0), new_name='loss_disc')
-
-      ### Round up gradients ###
+        loss_names += ['loss_l1', 'loss_gen_un_class', 'loss_gen_con_class', 'loss_layer_l2',
+                       'loss_disc_un_class', 'loss_disc_con_class', 'loss_disc']
       with tf.device('/gpu:%d' % self.gpus[0]):
         gpu_str = lambda x: '_gpu_' + str(self.gpus[x])
-        for i in range(1, len(self.gpus)):
-          # gradients 
-          for j in range(len(self.out_tensors['gen_grads' + gpu_str(0)])):
-              if self.out_tensors['gen_grads' + gpu_str(0)][j] is not None:
-                self.out_tensors['gen_grads' + gpu_str(0)][j] += self.out_tensors['gen_grads' + gpu_str(i)][j]
-          if self.gan:
-            for j in range(len(self.out_tensors['disc_grads' + gpu_str(0)])):
-              if self.out_tensors['disc_grads' + gpu_str(0)][j] is not None:
-                self.out_tensors['disc_grads' + gpu_str(0)][j] += self.out_tensors['disc_grads' + gpu_str(i)][j]
+        for name in loss_names:
+          # scalars are summed and per sample losses concatenated in batch order
+          self.out_tensors[name] = tf.add_n([self.out_tensors[name + gpu_str(i)] 
+                                            for i in xrange(len(self.gpus))])
+          self.out_tensors[name + '_sample'] = tf.concat([self.out_tensors[name + gpu_str(i) + '_sample'] 
+                                                         for i in xrange(len(self.gpus))], axis=0)
+
+      ### Round up gradients ###
+      # the optimizer runs on gpu:0 so only the first reduced copy is used
+      devices = ['/gpu:%d' % x for x in self.gpus]
+      grad_names = ['gen_grads']
+      if self.gan:
+        grad_names.append('disc_grads')
+      for name in grad_names:
+        tower_grads = [self.out_tensors[name + gpu_str(i)] for i in xrange(len(self.gpus))]
+        self.out_tensors[name + gpu_str(0)] = all_reduce(tower_grads, devices,
+                                                 method=self.config.grad_reduce,
+                                                 bucket_size=self.config.grad_bucket_size,
+                                                 fp16=self.config.grad_fp16)[0]
 
       ### add loss summary ###
       tf.summary.scalar('loss_gen', self.out_tensors['loss_gen'])
@@ -347,22 +344,46 @@ class LatNet(object):
         tf.summary.scalar('loss_disc_con_class', self.out_tensors['loss_disc_con_class'])
         tf.summary.scalar('loss_disc', self.out_tensors['loss_disc'])
 
+      ### group staging puts ###
+      if self.input_staging:
+        self.out_tensors['stage_op'] = tf.group(*[self.out_tensors['stage' + gpu_str(i)] 
+                                                  for i in xrange(len(self.gpus))])
+
       ###### Train Operation ######
+      gen_grads = self.out_tensors['gen_grads' + gpu_str(0)]
+      if self.gan:
+        disc_grads = self.out_tensors['disc_grads' + gpu_str(0)]
+        if self.gan_fused:
+          # gen grads backprop through the discriminator so when both updates
+          # run in one call the disc update has to wait for them
+          with tf.control_dependencies([g for g in gen_grads if g is not None]):
+            disc_grads = [g if g is None else tf.identity(g) for g in disc_grads]
       self.gen_optimizer = Optimizer(self.config, name='gen', optimizer_name='adam')
       self.disc_optimizer = Optimizer(self.config, name='disc', optimizer_name='adam')
+      # batch norm moving averages are only updated with the gen train op, 
+      # in one session call they would run once for both train ops so this 
+      # keeps them updating once per step in fused and unfused mode
       update_ops = tf.get_collection(tf.GraphKeys.UPDATE_OPS)
       self.out_tensors['gen_train_op'] = self.gen_optimizer.train_op(gen_params, 
-                                               self.out_tensors['gen_grads' + gpu_str(0)], 
+                                               gen_grads, 
                                                self.out_tensors['gen_global_step'],
                                                mom1=self.config.beta1,
                                                other_update=update_ops)
+      # global step after the update so it can be fetched with the train op
+      with tf.control_dependencies([self.out_tensors['gen_train_op']]):
+        self.out_tensors['gen_global_step_updated'] = tf.identity(self.out_tensors['gen_global_step'])
       if self.gan:
         self.out_tensors['disc_train_op'] = self.disc_optimizer.train_op(disc_params, 
-                                                     self.out_tensors['disc_grads' + gpu_str(0)], 
+                                                     disc_grads, 
                                                      self.out_tensors['disc_global_step'],
-                                                     mom1=self.config.beta1,
-                                                     other_update=update_ops)
-  
+                                                     mom1=self.config.beta1)
+
+      # session is started separately so data processes can be forked first
+      self.graph = tf.get_default_graph()
+
+  def train_session(self):
+
+    with self.graph.as_default():
       ###### Start Session ######
       self.sess = self.start_session()
   
@@ -386,7 +407,7 @@ class LatNet(object):
     print(shape_converters.keys())
     return shape_converters
 
-  def eval_unroll(self):
+  def eval_unroll(self, padding_type=None):
 
     # graph
     with tf.Graph().as_default():
@@ -394,7 +415,7 @@ class LatNet(object):
       ###### Inputs to Graph ######
       # make input state and boundary
       self.add_tensor('state',     (1 + self.DxQy.dims) * [None] + [self.DxQy.Q])
-      self.add_tensor('boundary',  (1 + self.DxQy.dims) * [None] + [6])
+      self.add_tensor('boundary',  (1 + self.DxQy.dims) * [None] + [2*self.DxQy.dims + 2])
       self.add_tensor('cstate',    (1 + self.DxQy.dims) * [None] + [self.config.filter_size_compression])
       self.add_tensor('cboundary_first', (1 + self.DxQy.dims) * [None] + [2*self.config.filter_size_compression])
       self.add_tensor('cboundary', (1 + self.DxQy.dims) * [None] + [2*self.config.filter_size_compression])
@@ -420,10 +441,38 @@ class LatNet(object):
                                 out_name="cstate_from_cstate")
   
  
+      # compression mapping on the full domain with halo made in the graph
+      if padding_type is not None and self.config.full_domain:
+        self.add_tensor('cstate_full',    (1 + self.DxQy.dims) * [None] + [self.config.filter_size_compression])
+        self.add_tensor('cboundary_full', (1 + self.DxQy.dims) * [None] + [2*self.config.filter_size_compression])
+        subdomain = SubDomain(self.DxQy.dims*[0], self.DxQy.dims*[1])
+        halo = max(-self.shape_converters['cstate', 'cstate_from_cstate'].out_in_subdomain(copy(subdomain)).pos[0],
+                   -self.shape_converters['cstate', 'cstate_from_cstate_first'].out_in_subdomain(copy(subdomain)).pos[0])
+        self.mobius_pad_tensor(in_name='cstate_full', out_name='cstate_full_halo', 
+                               halo=halo, padding_type=padding_type)
+        # the compression mapping trims its cboundary in place so each
+        # mapping gets its own padded copy
+        self.mobius_pad_tensor(in_name='cboundary_full', out_name='cboundary_full_first_halo', 
+                               halo=halo, padding_type=padding_type)
+        self.mobius_pad_tensor(in_name='cboundary_full', out_name='cboundary_full_halo', 
+                               halo=halo, padding_type=padding_type)
+        self._compression_mapping(in_cstate_name="cstate_full_halo", 
+                                  in_cboundary_name="cboundary_full_first_halo",
+                                  out_name="cstate_from_cstate_full_first",
+                                  start_apply_boundary=True)
+        self._compression_mapping(in_cstate_name="cstate_full_halo", 
+                                  in_cboundary_name="cboundary_full_halo",
+                                  out_name="cstate_from_cstate_full")
+
+        # compressed state kept on device and stepped num_steps times per call
+        if self.config.resident_state:
+          self.resident_unroll(halo, padding_type)
+ 
       # decoder
       self._decoder_state(in_cstate_name="cstate", in_cboundary_name="cboundary_decoder", out_name="state_from_cstate")
-      self.out_tensors['vel_from_cstate'] = self.DxQy.lattice_to_vel(self.out_tensors['state_from_cstate'])
-      self.out_tensors['rho_from_cstate'] = self.DxQy.lattice_to_rho(self.out_tensors['state_from_cstate'])
+      moments = self.DxQy.lattice_to_moments(self.out_tensors['state_from_cstate'])
+      self.out_tensors['vel_from_cstate'] = moments['vel']
+      self.out_tensors['rho_from_cstate'] = moments['rho']
 
       ###### Start Session ######
       self.sess = self.start_session()
@@ -452,6 +501,12 @@ class LatNet(object):
     decoder_state    = lambda x, y: self.run('state_from_cstate',
                                  feed_dict={'cstate':x,
                                             'cboundary_decoder':y})
+    cmapping_full       = lambda x, y: self.run('cstate_from_cstate_full', 
+                                    feed_dict={'cstate_full':x,
+                                               'cboundary_full':y})
+    cmapping_first_full = lambda x, y: self.run('cstate_from_cstate_full_first', 
+                                    feed_dict={'cstate_full':x,
+                                               'cboundary_full':y})
 
     # shape converters
     encoder_shape_converter = self.shape_converters['state', 'cstate_from_state']
@@ -460,7 +515,7 @@ class LatNet(object):
 
     return (state_encoder, boundary_encoder, cmapping, cmapping_first, decoder_vel_rho,
             decoder_state, encoder_shape_converter, cmapping_shape_converter, 
-            decoder_shape_converter) # TODO This should probably be cleaned up
+            decoder_shape_converter, cmapping_full, cmapping_first_full) # TODO This should probably be cleaned up
 
   def fc(self, in_name, out_name,
          hidden, weight_name='fc', 
@@ -659,6 +714,66 @@ class LatNet(object):
       new_subdomain = self.shape_converters[in_name, match_name].out_in_subdomain(subdomain)
       self.trim_tensor(in_name, out_name, abs(new_subdomain.pos[0]))
 
+  def resident_unroll(self, halo, padding_type):
+    # variables holding the full compressed state and boundary, kept out of
+    # the checkpoint savers as local variables
+    cshape = (1 + self.DxQy.dims) * [None] + [self.config.filter_size_compression]
+    cbshape = (1 + self.DxQy.dims) * [None] + [2*self.config.filter_size_compression]
+    cstate_var = tf.Variable(tf.zeros([0]), name='resident_cstate', trainable=False, 
+                             validate_shape=False, collections=[tf.GraphKeys.LOCAL_VARIABLES])
+    cboundary_var = tf.Variable(tf.zeros([0]), name='resident_cboundary', trainable=False, 
+                                validate_shape=False, collections=[tf.GraphKeys.LOCAL_VARIABLES])
+
+    # load from host
+    self.out_tensors['load_resident'] = tf.group(
+        tf.assign(cstate_var, self.in_tensors['cstate_full'], validate_shape=False),
+        tf.assign(cboundary_var, self.in_tensors['cboundary_full'], validate_shape=False))
+
+    # read to host
+    self.out_tensors['resident_cstate'] = tf.identity(cstate_var.read_value())
+    self.out_tensors['resident_cstate'].set_shape(cshape)
+
+    # halo on boundary is made once per call
+    self.out_tensors['resident_cboundary'] = tf.identity(cboundary_var.read_value())
+    self.out_tensors['resident_cboundary'].set_shape(cbshape)
+    self.mobius_pad_tensor(in_name='resident_cboundary', out_name='resident_cboundary_halo', 
+                           halo=halo, padding_type=padding_type)
+
+    # loop compression mapping on device, summaries made in the loop body 
+    # can not be merged so they are dropped
+    summaries = tf.get_collection(tf.GraphKeys.SUMMARIES)
+    self.in_tensors['num_steps'] = tf.placeholder(tf.int32, [], name='num_steps')
+    def step(i, cstate):
+      cstate.set_shape(cshape)
+      self.out_tensors['resident_cstate_step'] = cstate
+      self.mobius_pad_tensor(in_name='resident_cstate_step', out_name='resident_cstate_step_halo', 
+                             halo=halo, padding_type=padding_type)
+      self._compression_mapping(in_cstate_name="resident_cstate_step_halo", 
+                                in_cboundary_name="resident_cboundary_halo",
+                                out_name="resident_cstate_next")
+      return i + 1, self.out_tensors['resident_cstate_next']
+    _, cstate = tf.while_loop(lambda i, cstate: i < self.in_tensors['num_steps'], step,
+                              [tf.constant(0), self.out_tensors['resident_cstate']],
+                              shape_invariants=[tf.TensorShape([]), tf.TensorShape(cshape)])
+    tf.get_collection_ref(tf.GraphKeys.SUMMARIES)[:] = summaries
+    self.out_tensors['step_resident'] = tf.group(tf.assign(cstate_var, cstate, validate_shape=False))
+
+  def load_resident_cstate(self, cstate, cboundary):
+    self.run('load_resident', feed_dict={'cstate_full':cstate, 'cboundary_full':cboundary})
+
+  def step_resident_cstate(self, num_steps):
+    self.run('step_resident', feed_dict={'num_steps':num_steps})
+
+  def read_resident_cstate(self):
+    return self.run('resident_cstate')
+
+  def mobius_pad_tensor(self, in_name, out_name, halo, padding_type):
+    # pad a full domain tensor with a periodic or zero halo, padded cells
+    # are marked in the pad tensor
+    self.out_tensors[out_name] = nn.mobius_pad(self.out_tensors[in_name], halo, padding_type)
+    self.out_pad_tensors[out_name] = 1.0 - nn.mobius_pad(tf.ones_like(self.out_tensors[in_name][...,0:1]),
+                                                         halo, padding_type)
+
   def image_combine(self, a_name, b_name, mask_name, out_name):
     # as seen in "Generating Videos with Scene Dynamics" figure 1
     self.out_tensors[out_name] = ((self.out_tensors[a_name] *      self.out_tensors[mask_name] )
@@ -696,12 +811,11 @@ class LatNet(object):
     self.out_tensors[name] = nonlin(self.out_tensors[name])
 
   def l1_loss(self, true_name, pred_name, loss_name, factor=None):
-    self.out_tensors[loss_name] = tf.reduce_mean(tf.abs(tf.stop_gradient(self.out_tensors[ true_name])
-                                              - self.out_tensors[pred_name]))
-    if factor is not None:
-      self.out_tensors[loss_name] = factor * self.out_tensors[loss_name]
+    sample_loss = self.sample_mean(tf.abs(tf.stop_gradient(self.out_tensors[ true_name])
+                                          - self.out_tensors[pred_name]))
+    self.set_loss(loss_name, sample_loss, factor)
 
-  def l2_loss(self, true_name, pred_name, loss_name, factor=None, normalize=None):
+  def l2_loss(self, true_name, pred_name, loss_name, factor=None, normalize=None, num_seq=None):
 
     with tf.device('/cpu:0'):
       self.out_tensors[true_name + '_' + pred_name] = tf.abs(self.out_tensors[true_name]
@@ -713,13 +827,15 @@ class LatNet(object):
       std = tf.sqrt(var)
       self.out_tensors[true_name] = self.out_tensors[true_name] / (1000.0 * std + 0.0001) # TODO take out 10.0, only in to compare with previous code
       self.out_tensors[pred_name] = self.out_tensors[pred_name] / (1000.0 * std + 0.0001)
-      self.out_tensors[loss_name] = tf.nn.l2_loss(tf.stop_gradient(self.out_tensors[ true_name]) 
-                                                - self.out_tensors[pred_name])
+      sample_loss = self.sample_l2(tf.stop_gradient(self.out_tensors[ true_name]) 
+                                   - self.out_tensors[pred_name])
     elif normalize == 'vel':
-      vel_true = self.DxQy.lattice_to_vel(self.out_tensors[true_name])
-      vel_pred = self.DxQy.lattice_to_vel(self.out_tensors[pred_name])
-      rho_true = self.DxQy.lattice_to_rho(self.out_tensors[true_name])[...,0]
-      rho_pred = self.DxQy.lattice_to_rho(self.out_tensors[pred_name])[...,0]
+      moments_true = self.DxQy.lattice_to_moments(self.out_tensors[true_name])
+      moments_pred = self.DxQy.lattice_to_moments(self.out_tensors[pred_name])
+      vel_true = moments_true['vel']
+      vel_pred = moments_pred['vel']
+      rho_true = moments_true['rho'][...,0]
+      rho_pred = moments_pred['rho'][...,0]
 
       vel_true_x = vel_true[...,0]
       vel_true_y = vel_true[...,1]
@@ -747,29 +863,54 @@ class LatNet(object):
       #rho_true = (rho_true)/(rho_true_max - rho_true_min + 1e-2)
       #rho_pred = (rho_pred)/(rho_true_max - rho_true_min + 1e-2)
 
-      self.out_tensors[loss_name] = 0.0
-      self.out_tensors[loss_name] += tf.nn.l2_loss(vel_true_x - vel_pred_x)
-      self.out_tensors[loss_name] += tf.nn.l2_loss(vel_true_y - vel_pred_y)
-      self.out_tensors[loss_name] += tf.nn.l2_loss(rho_true - rho_pred)
+      sample_loss = self.sample_l2(vel_true_x - vel_pred_x)
+      sample_loss += self.sample_l2(vel_true_y - vel_pred_y)
+      sample_loss += self.sample_l2(rho_true - rho_pred)
       #self.out_tensors[loss_name] += tf.reduce_mean(tf.abs(vel_true_x - vel_pred_x))
       #self.out_tensors[loss_name] += tf.reduce_mean(tf.abs(vel_true_y - vel_pred_y))
       #self.out_tensors[loss_name] += tf.reduce_mean(tf.abs(rho_true - rho_pred))
     elif normalize is None:
-      self.out_tensors[loss_name] = tf.nn.l2_loss(tf.stop_gradient(self.out_tensors[ true_name]) 
-                                                - self.out_tensors[pred_name])
-    if factor is not None:
-      self.out_tensors[loss_name] = factor * self.out_tensors[loss_name]
-
-  def gen_loss(self, class_name, loss_name, factor=None):
-    self.out_tensors[loss_name] = -tf.reduce_mean(tf.log(self.out_tensors[class_name]))
-    if factor is not None:
-      self.out_tensors[loss_name] = factor * self.out_tensors[loss_name]
-
-  def disc_loss(self, true_class_name, pred_class_name, loss_name, factor=None):
-    self.out_tensors[loss_name] = -tf.reduce_mean(tf.log(self.out_tensors[true_class_name])
-                                          + tf.log(1.0 - self.out_tensors[pred_class_name]))
+      sample_loss = self.sample_l2(tf.stop_gradient(self.out_tensors[ true_name]) 
+                                   - self.out_tensors[pred_name])
+    self.set_loss(loss_name, sample_loss, factor, num_seq)
+
+  def gen_loss(self, class_name, loss_name, factor=None, num_seq=None):
+    sample_loss = -self.sample_mean(tf.log(self.out_tensors[class_name]))
+    self.set_loss(loss_name, sample_loss, factor, num_seq)
+
+  def disc_loss(self, true_class_name, pred_class_name, loss_name, factor=None, num_seq=None):
+    sample_loss = -self.sample_mean(tf.log(self.out_tensors[true_class_name])
+                                    + tf.log(1.0 - self.out_tensors[pred_class_name]))
+    self.set_loss(loss_name, sample_loss, factor, num_seq)
+
+  def sample_l2(self, x):
+    # tf.nn.l2_loss of every sample in the batch
+    axis = range(1, len(x.get_shape()))
+    return 0.5 * tf.reduce_sum(tf.square(x), axis=axis)
+
+  def sample_mean(self, x):
+    # per sample share of tf.reduce_mean over the whole batch
+    axis = range(1, len(x.get_shape()))
+    return tf.reduce_mean(x, axis=axis) / tf.cast(tf.shape(x)[0], tf.float32)
+
+  def set_loss(self, loss_name, sample_loss, factor=None, num_seq=None):
+    # every loss keeps a per sample vector next to the scalar, the
+    # scalar is the sum of the vector
+    if num_seq is not None:
+      # fold seq steps stacked on the batch back onto their sample
+      sample_loss = tf.reduce_sum(tf.reshape(sample_loss, [num_seq, -1]), axis=0)
     if factor is not None:
-      self.out_tensors[loss_name] = factor * self.out_tensors[loss_name]
+      sample_loss = factor * sample_loss
+    self.out_tensors[loss_name + '_sample'] = sample_loss
+    self.out_tensors[loss_name] = tf.reduce_sum(sample_loss)
+
+  def add_loss(self, sum_name, loss_name):
+    # add scalar and per sample loss to a running total
+    for suffix in ['', '_sample']:
+      if sum_name + suffix in self.out_tensors:
+        self.out_tensors[sum_name + suffix] += self.out_tensors[loss_name + suffix]
+      else:
+        self.out_tensors[sum_name + suffix] = self.out_tensors[loss_name + suffix]
 
   def combine_pipe(self, other_pipe):
     self.in_tensors.update(other_pipe.in_tensors)
@@ -804,6 +945,22 @@ class LatNet(object):
     self.out_pad_tensors[name] = pad_tensor
     self.shape_converters[name,name] = ShapeConverter()
      
+  def add_staging_area(self, names, stage_name):
+    # inputs are put in a staging area on the current device and the graph
+    # reads the previously staged values. Feeding the stage op with the next
+    # batch each step overlaps the host to device copy with compute.
+    in_tensors = []
+    for name in names:
+      in_tensors += [self.in_tensors[name], self.in_pad_tensors[name]]
+    area = StagingArea(dtypes=[x.dtype for x in in_tensors],
+                       shapes=[x.get_shape() for x in in_tensors])
+    self.out_tensors[stage_name] = area.put(in_tensors)
+    out_tensors = area.get()
+    for i in xrange(len(names)):
+      self.out_tensors[names[i]] = out_tensors[2*i]
+      self.out_pad_tensors[names[i]] = out_tensors[2*i+1]
+    self.staged_names += names
+
   def add_phase(self): 
     self.in_tensors['phase'] = tf.placeholder(tf.bool, name='phase')
     self.out_tensors['phase'] = self.in_tensors['phase']
@@ -823,14 +980,14 @@ class LatNet(object):
 
   def lattice_summary(self, in_name, summary_name, 
                       display_norm=True, display_vel=True, display_pressure=True):
+    moments = self.DxQy.lattice_to_moments(self.out_tensors[in_name])
     if display_norm:
-      tf.summary.image(summary_name + '_norm', self.DxQy.lattice_to_norm(self.out_tensors[in_name]))
+      tf.summary.image(summary_name + '_norm', moments['norm'])
     if display_pressure:
-      tf.summary.image(summary_name + '_rho', self.DxQy.lattice_to_rho(self.out_tensors[in_name]))
+      tf.summary.image(summary_name + '_rho', moments['rho'])
     if display_vel:
-      vel = self.DxQy.lattice_to_vel(self.out_tensors[in_name])
-      tf.summary.image(summary_name + '_vel_x', vel[...,0:1])
-      tf.summary.image(summary_name + '_vel_y', vel[...,1:2])
+      tf.summary.image(summary_name + '_vel_x', moments['vel'][...,0:1])
+      tf.summary.image(summary_name + '_vel_y', moments['vel'][...,1:2])
 
   def boundary_summary(self, in_name, summary_name):
     tf.summary.image('physical_boundary', self.out_tensors[in_name][...,0:1])
@@ -840,7 +997,24 @@ class LatNet(object):
       tf.summary.image('vel_z_boundary', self.out_tensors[in_name][...,3:4])
     tf.summary.image('density_boundary', self.out_tensors[in_name][...,-1:])
 
-  def run(self, out_names, feed_dict=None, return_dict=False):
+  def make_tf_feed_dict(self, feed_dict, staged=False):
+    # staged inputs are fed into the staging area placeholders when staged
+    # is True, otherwise straight into the tensors read from the staging
+    # area so nothing is dequeued
+    tf_feed_dict = {}
+    for name in feed_dict.keys():
+      if (name in self.staged_names) and not staged:
+        tensor, pad_tensor = self.out_tensors[name], self.out_pad_tensors[name]
+      else:
+        tensor, pad_tensor = self.in_tensors[name], self.in_pad_tensors.get(name)
+      if type(feed_dict[name]) is tuple:
+        tf_feed_dict[tensor] = feed_dict[name][0]
+        tf_feed_dict[pad_tensor] = feed_dict[name][1]
+      else:
+        tf_feed_dict[tensor] = feed_dict[name]
+    return tf_feed_dict
+
+  def run(self, out_names, feed_dict=None, return_dict=False, staged=False):
     # convert out_names to tensors 
     if type(out_names) is list:
       out_tensors = [self.out_tensors[x] for x in out_names]
@@ -849,13 +1023,7 @@ class LatNet(object):
 
     # convert feed_dict to tensorflow version
     if feed_dict is not None:
-      tf_feed_dict = {}
-      for name in feed_dict.keys():
-        if type(feed_dict[name]) is tuple:
-          tf_feed_dict[self.in_tensors[name]] = feed_dict[name][0]
-          tf_feed_dict[self.in_pad_tensors[name]] = feed_dict[name][1]
-        else:
-          tf_feed_dict[self.in_tensors[name]] = feed_dict[name]
+      tf_feed_dict = self.make_tf_feed_dict(feed_dict, staged=staged)
     else:
       tf_feed_dict=None
 
@@ -874,10 +1042,31 @@ class LatNet(object):
       output = tf_output
     return output
 
+  def train_step(self, out_names, feed_dict, staged=False, summary=False):
+    # one session call for the train ops, losses, the updated global step 
+    # and possibly the summaries of the same forward pass
+    out_tensors = [self.out_tensors[x] for x in out_names]
+    out_tensors.append(self.out_tensors['gen_global_step_updated'])
+    if summary:
+      out_tensors.append(self.saver.summary_op)
+
+    # run with tensorflow
+    tf_feed_dict = self.make_tf_feed_dict(feed_dict, staged=staged)
+    tf_output = self.sess.run(out_tensors, feed_dict=tf_feed_dict)
+
+    # make output dictionary and write summary
+    output = {}
+    for i in xrange(len(out_names)):
+      output[out_names[i]] = tf_output[i]
+    output['gen_global_step'] = int(tf_output[len(out_names)])
+    if summary:
+      self.saver.add_summary(tf_output[-1], output['gen_global_step'])
+    return output
+
   def start_session(self):
     #gpu_options = tf.GPUOptions(per_process_gpu_memory_fraction=.9)
     #sess = tf.Session(config=tf.ConfigProto(gpu_options=gpu_options))
     sess = tf.Session()
-    init = tf.global_variables_initializer()
+    init = tf.group(tf.global_variables_initializer(), tf.local_variables_initializer())
     sess.run(init)
     return sess
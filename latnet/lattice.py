@@ -1,6 +1,7 @@
 
 import tensorflow as tf
 import numpy as np
+import itertools
 from nn import int_shape, simple_conv_2d, simple_conv_3d, simple_trans_conv_2d, simple_trans_conv_3d
 
 # helper function
@@ -25,11 +26,28 @@ class DxQy:
 
   @classmethod
   def lattice_to_vel(cls, lattice):
-    c = cls._expand(lattice, cls.c)
-    c = cls._convert(lattice, c)
-    lattice = cls._expand_lattice(lattice)
-    vel = cls._reduce_lattice(c * lattice)
-    return vel
+    return cls._dot(lattice, cls.c)
+
+  @classmethod
+  def lattice_to_moments(cls, lattice, stress=False):
+    # rho, vel (first moment like lattice_to_vel), its norm and possibly 
+    # the stress (second moment) from a single product with the moment matrix
+    if stress:
+      moments = cls._dot(lattice, cls.stress_moment_matrix)
+    else:
+      moments = cls._dot(lattice, cls.moment_matrix)
+    out = {}
+    out['rho'] = moments[...,0:1]
+    out['vel'] = moments[...,1:1+cls.dims]
+    out['norm'] = cls.vel_to_norm(out['vel'])
+    if stress:
+      out['stress'] = moments[...,1+cls.dims:]
+      if is_numpy(lattice):
+        out['stress'] = out['stress'].reshape(out['stress'].shape[:-1] + (cls.dims, cls.dims))
+      else:
+        out['stress'] = tf.reshape(out['stress'], tf.concat([tf.shape(out['stress'])[:-1], 
+                                                             [cls.dims, cls.dims]], axis=0))
+    return out
 
   @classmethod
   def lattice_to_norm(cls, lattice):
@@ -47,11 +65,12 @@ class DxQy:
       rho = tf.expand_dims(rho, axis=-1)
     return rho
 
+  @classmethod
   def lattice_to_divergence(cls, lattice):
     assert not is_numpy(lattice), "divergence not supported for numpy"
-    velocity = cls.lattice_to_vel(lattice)
+    vel = cls.lattice_to_vel(lattice)
     if cls.dims == 2:
-      divergence = nn.simple_conv_2d(vel, cls.divergence_kernel)
+      divergence = simple_conv_2d(vel, cls.divergence_kernel)
       divergence = divergence[:,1:-1,1:-1,:]
     elif cls.dims == 3:
       divergence = simple_conv_3d(vel, cls.divergence_kernel)
@@ -102,6 +121,137 @@ class DxQy:
   def vel_to_freq(cls, vel):
     pass
 
+  @classmethod
+  def vel_to_feq(cls, vel, rho=None):
+    # equilibrium with weights subtracted like subtract_lattice, vel has
+    # the components in the last dim
+    if type(vel) in [list, tuple]:
+      vel = np.array(vel)
+    if is_numpy(vel):
+      vel_dot_c = np.dot(vel, cls.c.T)
+      vel_dot_vel = np.sum(vel * vel, axis=-1, keepdims=True)
+    else:
+      vel_dot_c = tf.tensordot(vel, tf.constant(cls.c.T, dtype=vel.dtype), axes=1)
+      vel_dot_vel = tf.reduce_sum(vel * vel, axis=-1, keep_dims=True)
+    w = cls._expand(vel_dot_c, cls.weights)
+    w = cls._convert(vel_dot_c, w)
+    feq = 1.0 + 3.0*vel_dot_c + 4.5*vel_dot_c*vel_dot_c - 1.5*vel_dot_vel
+    if rho is not None:
+      feq = rho * feq
+    feq = w * feq - w
+    return feq
+
+  @classmethod
+  def symmetry_field(cls, field, sym):
+    # moves field values by symmetry sym of the lattice, the spatial dims 
+    # are the ones before the last dim so a batch dim is optional
+    axes, flips = cls.symmetry_axes[sym], cls.symmetry_flips[sym]
+    if is_numpy(field):
+      offset = len(field.shape) - 1 - cls.dims
+      field = np.transpose(field, range(offset) + [offset + x for x in axes] + [offset + cls.dims])
+      field = field[tuple(offset*[slice(None)] + [slice(None, None, -1) if x else slice(None) for x in flips])]
+    else:
+      offset = len(field.get_shape()) - 1 - cls.dims
+      field = tf.transpose(field, range(offset) + [offset + x for x in axes] + [offset + cls.dims])
+      field = tf.reverse(field, axis=[offset + i for i in xrange(cls.dims) if flips[i]])
+    return field
+
+  @classmethod
+  def symmetry_components(cls, vec, sym):
+    # transforms vector components without moving them
+    signs = cls._expand(vec, cls.symmetry_signs[sym])
+    signs = cls._convert(vec, signs)
+    return cls._gather(vec, cls.symmetry_component_inds[sym]) * signs
+
+  @classmethod
+  def symmetry_vector(cls, vec, sym):
+    return cls.symmetry_components(cls.symmetry_field(vec, sym), sym)
+
+  @classmethod
+  def symmetry_lattice(cls, lattice, sym):
+    return cls._gather(cls.symmetry_field(lattice, sym), cls.symmetry_perms[sym])
+
+  @classmethod
+  def symmetry_index(cls, axes, flips):
+    for i in xrange(len(cls.symmetry_axes)):
+      if (list(cls.symmetry_axes[i]) == list(axes) and 
+          list(cls.symmetry_flips[i]) == list(flips)):
+        return i
+
+  @classmethod
+  def symmetries_for_shape(cls, shape):
+    # symmetries that keep the spatial shape the same
+    shape = list(shape)
+    return [i for i in xrange(len(cls.symmetry_axes)) 
+            if [shape[x] for x in cls.symmetry_axes[i]] == shape]
+
+  @classmethod
+  def _dot(cls, lattice, mat):
+    # contracts the lattice directions with mat without temporaries
+    if is_numpy(lattice):
+      out = np.dot(lattice, mat.astype(lattice.dtype))
+    else:
+      out = tf.tensordot(lattice, tf.constant(mat, dtype=lattice.dtype), axes=1)
+      out.set_shape(lattice.get_shape()[:-1].concatenate([mat.shape[1]]))
+    return out
+
+  @classmethod
+  def _gather(cls, lattice, inds):
+    if is_numpy(lattice):
+      lattice = lattice[..., inds]
+    else:
+      lattice = tf.gather(lattice, inds, axis=len(lattice.get_shape())-1)
+    return lattice
+
+def make_symmetry_tables(lattice_type):
+  # tables for every permutation and reflection of the spatial axes. 
+  # Component c_axes[k] of c moves along spatial axis k. After symmetry sym
+  # a vector v becomes v[symmetry_component_inds[sym]] * symmetry_signs[sym]
+  # and direction i of the lattice is taken from symmetry_perms[sym][i]
+  dims = lattice_type.dims
+  c_axes = lattice_type.c_axes
+  c = lattice_type.c[:, c_axes]
+  (symmetry_axes, symmetry_flips, symmetry_component_inds, 
+   symmetry_signs, symmetry_perms) = [], [], [], [], []
+  for axes in itertools.permutations(range(dims)):
+    for flips in itertools.product([False, True], repeat=dims):
+      signs = np.array([-1 if x else 1 for x in flips])
+      new_c = c[:, list(axes)] * signs
+      perm = np.zeros(lattice_type.Q, dtype=np.int32)
+      for i in xrange(lattice_type.Q):
+        perm[np.where(np.all(c == new_c[i], axis=1))[0][0]] = i
+      component_inds = np.zeros(dims, dtype=np.int32)
+      component_signs = np.zeros(dims, dtype=np.float32)
+      for k in xrange(dims):
+        component_inds[c_axes[k]] = c_axes[axes[k]]
+        component_signs[c_axes[k]] = signs[k]
+      symmetry_axes.append(np.array(axes, dtype=np.int32))
+      symmetry_flips.append(np.array(flips))
+      symmetry_component_inds.append(component_inds)
+      symmetry_signs.append(component_signs)
+      symmetry_perms.append(perm)
+  lattice_type.symmetry_axes = symmetry_axes
+  lattice_type.symmetry_flips = symmetry_flips
+  lattice_type.symmetry_component_inds = symmetry_component_inds
+  lattice_type.symmetry_signs = symmetry_signs
+  lattice_type.symmetry_perms = symmetry_perms
+  lattice_type.num_symmetries = len(symmetry_axes)
+
+def make_moment_tables(lattice_type):
+  # columns are 1, c and c_a c_b so one product gives rho, vel and stress
+  c = lattice_type.c.astype(np.float64)
+  lattice_type.moment_matrix = np.concatenate([np.ones((lattice_type.Q, 1)), c], axis=1)
+  stress = (c[:,:,np.newaxis] * c[:,np.newaxis,:]).reshape((lattice_type.Q, -1))
+  lattice_type.stress_moment_matrix = np.concatenate([lattice_type.moment_matrix, stress], axis=1)
+
+def make_force_kernel(lattice_type):
+  # kernel picking each moving direction from the neighbor it streams from
+  kernel = np.zeros(lattice_type.dims*[3] + [lattice_type.Q, 1])
+  for i in xrange(1, lattice_type.Q):
+    pos = [1 - lattice_type.c[i, x] for x in lattice_type.c_axes]
+    kernel[tuple(pos + [i, 0])] = 1.0
+  return kernel
+
 class D2Q9(DxQy):
   dims = 2
   Q = 9
@@ -112,6 +262,7 @@ class D2Q9(DxQy):
   c = np.array([[0 ,0], [ 0, 1], [ 1,0],
                 [0,-1], [-1, 0], [ 1,1],
                 [1,-1], [-1,-1], [-1,1]])
+  c_axes = [0, 1]
 
   divergence_kernel = np.zeros((3,3,2,1))
   divergence_kernel[2,1,0,0] =  1.0
@@ -129,49 +280,21 @@ class D2Q9(DxQy):
   force_kernel[2,2,7,0] = 1.0 # down left
   force_kernel[2,0,8,0] = 1.0 # down right
 
-  def vel_to_feq(self, vel):
-    vel = np.array(vel)
-    vel_dot_vel = np.sum(vel * vel)
-    vel_dot_c = np.sum(np.expand_dims(vel, axis=0) * self.c, axis=-1)
-    feq = self.weights * (1.0 + 
-                          3.0*vel_dot_c + 
-                          4.5*vel_dot_c*vel_dot_c - 
-                          1.5*vel_dot_vel)
-    feq = feq - self.weights
-    return feq 
-
-  def rotate_lattice(self, lattice, rotation):
-    for i in xrange(rotation):
-      lattice = self.rotate_lattice_left(lattice)
-    return lattice
+  @classmethod
+  def rotate_lattice(cls, lattice, rotation):
+    # rotation left by 90 degrees rotation times
+    axes, flips = [[0, 1], [1, 0], [0, 1], [1, 0]], [[False, False], [True, False], [True, True], [False, True]]
+    sym = cls.symmetry_index(axes[rotation % 4], flips[rotation % 4])
+    return cls.symmetry_lattice(lattice, sym)
 
-  def rotate_lattice_left(self, lattice):
-    lattice_split = np.split(lattice, 9, -1)
-    (lattice_split[1], lattice_split[2], 
-     lattice_split[3], lattice_split[4], 
-     lattice_split[5], lattice_split[6], 
-     lattice_split[7], lattice_split[8]) = (
-     lattice_split[2], lattice_split[3], 
-     lattice_split[4], lattice_split[1], 
-     lattice_split[6], lattice_split[7], 
-     lattice_split[8], lattice_split[5])
-    lattice = np.concatenate(lattice_split, axis = -1)
-    lattice = np.rot90(lattice, k=1, axes=(0,1))
-    return lattice
+  @classmethod
+  def rotate_lattice_left(cls, lattice):
+    return cls.rotate_lattice(lattice, 1)
 
-  def flip_lattice(self, lattice):
-    lattice_split = np.split(lattice, 9, -1)
-    (lattice_split[1], lattice_split[2], 
-     lattice_split[3], lattice_split[4], 
-     lattice_split[5], lattice_split[6], 
-     lattice_split[7], lattice_split[8]) = (
-     lattice_split[1], lattice_split[4], 
-     lattice_split[3], lattice_split[2], 
-     lattice_split[8], lattice_split[7], 
-     lattice_split[6], lattice_split[5])
-    lattice = np.concatenate(lattice_split, axis = -1)
-    lattice = np.flipud(lattice)
-    return lattice
+  @classmethod
+  def flip_lattice(cls, lattice):
+    sym = cls.symmetry_index([0, 1], [True, False])
+    return cls.symmetry_lattice(lattice, sym)
 
 class D3Q15(DxQy):
   dims = 3
@@ -186,6 +309,8 @@ class D3Q15(DxQy):
                 [ 0, 0,-1], [ 1, 1, 1], [-1,-1,-1],
                 [ 1, 1,-1], [-1,-1, 1], [ 1,-1, 1],
                 [-1, 1,-1], [ 1,-1,-1], [-1, 1, 1]])
+  # c is x, y, z while arrays are z, y, x
+  c_axes = [2, 1, 0]
 
   divergence_kernel = np.zeros((3,3,3,3,1))
   divergence_kernel[2,1,1,2,0] =  1.0
@@ -211,13 +336,57 @@ class D3Q15(DxQy):
   force_kernel[2,2,0,13,0] = 1.0 # down right in 
   force_kernel[0,0,2,14,0] = 1.0 # up left out
 
-  def vel_to_feq(self, vel):
-    print("vel_to_feq not implemented for D3Q15 yet")
-    exit()
+class D3Q19(DxQy):
+  dims = 3
+  Q = 19
+  weights = np.array([1./3.,
+                      1./18., 1./18., 1./18., 1./18., 1./18., 1./18.,
+                      1./36., 1./36., 1./36., 1./36., 1./36., 1./36.,
+                      1./36., 1./36., 1./36., 1./36., 1./36., 1./36.])
+  c = np.array([[ 0, 0, 0], [ 1, 0, 0], [-1, 0, 0],
+                [ 0, 1, 0], [ 0,-1, 0], [ 0, 0, 1],
+                [ 0, 0,-1], [ 1, 1, 0], [-1, 1, 0],
+                [ 1,-1, 0], [-1,-1, 0], [ 1, 0, 1],
+                [-1, 0, 1], [ 1, 0,-1], [-1, 0,-1],
+                [ 0, 1, 1], [ 0,-1, 1], [ 0, 1,-1],
+                [ 0,-1,-1]])
+  c_axes = [2, 1, 0]
+
+  divergence_kernel = D3Q15.divergence_kernel
+
+class D3Q27(DxQy):
+  dims = 3
+  Q = 27
+  weights = np.array([8./27.,
+                      2./27.,  2./27.,  2./27.,  2./27.,  2./27.,  2./27.,
+                      1./54.,  1./54.,  1./54.,  1./54.,  1./54.,  1./54.,
+                      1./54.,  1./54.,  1./54.,  1./54.,  1./54.,  1./54.,
+                      1./216., 1./216., 1./216., 1./216., 
+                      1./216., 1./216., 1./216., 1./216.])
+  c = np.array([[ 0, 0, 0], [ 1, 0, 0], [-1, 0, 0],
+                [ 0, 1, 0], [ 0,-1, 0], [ 0, 0, 1],
+                [ 0, 0,-1], [ 1, 1, 0], [-1, 1, 0],
+                [ 1,-1, 0], [-1,-1, 0], [ 1, 0, 1],
+                [-1, 0, 1], [ 1, 0,-1], [-1, 0,-1],
+                [ 0, 1, 1], [ 0,-1, 1], [ 0, 1,-1],
+                [ 0,-1,-1], [ 1, 1, 1], [-1, 1, 1],
+                [ 1,-1, 1], [-1,-1, 1], [ 1, 1,-1],
+                [-1, 1,-1], [ 1,-1,-1], [-1,-1,-1]])
+  c_axes = [2, 1, 0]
+
+  divergence_kernel = D3Q15.divergence_kernel
 
 TYPES = {}
 TYPES['D2Q9']  = D2Q9
 TYPES['D3Q15'] = D3Q15
+TYPES['D3Q19'] = D3Q19
+TYPES['D3Q27'] = D3Q27
+
+for lattice_type in TYPES.values():
+  make_symmetry_tables(lattice_type)
+  make_moment_tables(lattice_type)
+  if not hasattr(lattice_type, 'force_kernel'):
+    lattice_type.force_kernel = make_force_kernel(lattice_type)
 
 """
 def lattice_to_flux(lattice, boundary):
@@ -23,7 +23,14 @@ class NetworkSaver:
                            'debug_sailfish', 'every', 'unit_test', 'propagation_enabled',
                            'time_dependence', 'space_dependence', 'incompressible', 
                            'relaxation_enabled', 'quiet', 'periodic_x', 'domain_name',
-                           'periodic_y', 'train_autoencoder']
+                           'periodic_y', 'train_autoencoder', 'use_state_store',
+                           'data_workers', 'input_staging', 'eval_batch_size',
+                           'eval_memory', 'eval_memory_factor', 'full_domain', 'resident_state', 'cboundary_cache_dir',
+                           'cboundary_cache_size', 'output_backlog', 'save_chunk',
+                           'save_precision', 'save_compressed', 'augment',
+                           'gen_gpus', 'gen_jobs_per_gpu', 'gen_retries', 'replay_capacity', 'priority_alpha',
+                           'gan_fused', 'gan_disc_every', 'grad_reduce', 
+                           'grad_bucket_size', 'grad_fp16']
 
     self.checkpoint_path = self._make_checkpoint_path()
     self._make_saver()
@@ -101,12 +108,19 @@ class NetworkSaver:
     else:
       print("using rand init")
 
+  def latest_checkpoint(self):
+    return tf.train.latest_checkpoint(self.checkpoint_path)
+
   def save_checkpoint(self, sess, global_step):
     save_path = os.path.join(self.checkpoint_path, 'model.ckpt')
     self.saver_all.save(sess, save_path, global_step=global_step)  
 
   def save_summary(self, sess, feed_dict, global_step):
     summary_str = sess.run(self.summary_op, feed_dict=feed_dict)
+    self.add_summary(summary_str, global_step)
+
+  def add_summary(self, summary_str, global_step):
+    # summary_str already fetched, e.g. together with a train step
     self.summary_writer.add_summary(summary_str, global_step) 
 
     
@@ -286,6 +286,31 @@ def trim_tensor(x, trim):
     x = x[:,trim:-trim, trim:-trim, trim:-trim]
   return x
 
+def mobius_pad(x, halo, padding_type):
+  # pad spatial dims by halo, periodic dims wrap around the others are zero
+  rank = len(x.get_shape())
+  for i in xrange(rank - 2):
+    axis = i + 1
+    if padding_type[i] == 'periodic':
+      # a halo larger than the dim wraps more than once
+      dim = x.get_shape()[axis].value
+      wrap = x
+      if dim is not None and halo > dim:
+        wrap = tf.concat((halo/dim + 1)*[x], axis=axis)
+      top    = wrap[axis*(slice(None),) + (slice(-halo, None),)]
+      bottom = wrap[axis*(slice(None),) + (slice(0, halo),)]
+      if dim is None:
+        check = tf.assert_less_equal(halo, tf.shape(x)[axis],
+                                     message="mobius_pad halo larger than periodic dim")
+        with tf.control_dependencies([check]):
+          top = tf.identity(top)
+      x = tf.concat([top, x, bottom], axis=axis)
+    else:
+      paddings = rank*[[0,0]]
+      paddings[axis] = [halo, halo]
+      x = tf.pad(x, paddings)
+  return x
+
 def res_block(x, a=None, 
               filter_size=16, 
               kernel_size=3, 
@@ -0,0 +1,65 @@
+
+import threading
+import Queue
+
+class OutputStage:
+  # decodes, visualizes and saves snapshots of the compressed state on
+  # background threads so the simulation loop only pays for the mapping.
+  # at most backlog snapshots wait in each stage before put blocks
+
+  def __init__(self, decode, vis, saver, backlog):
+    self.decode = decode
+    self.vis = vis
+    self.saver = saver
+    self.error = None
+
+    # decode thread feeds the write thread, one thread each keeps order
+    self.decode_queue = Queue.Queue(maxsize=backlog)
+    self.write_queue = Queue.Queue(maxsize=backlog)
+    self.decode_thread = threading.Thread(target=self.decode_worker)
+    self.write_thread = threading.Thread(target=self.write_worker)
+    self.decode_thread.daemon = True
+    self.write_thread.daemon = True
+    self.decode_thread.start()
+    self.write_thread.start()
+
+  def put(self, iteration, cstate, cboundary):
+    self.check_error()
+    self.decode_queue.put((iteration, cstate, cboundary))
+
+  def close(self):
+    # flush remaining snapshots
+    self.decode_queue.put(None)
+    self.decode_thread.join()
+    self.write_thread.join()
+    self.check_error()
+
+  def check_error(self):
+    if self.error is not None:
+      raise self.error
+
+  def decode_worker(self):
+    while True:
+      snapshot = self.decode_queue.get()
+      if snapshot is None:
+        break
+      iteration, cstate, cboundary = snapshot
+      try:
+        vel, rho = self.decode(cstate, cboundary)
+      except Exception as e:
+        self.error = e
+        continue
+      self.write_queue.put((iteration, vel, rho, cstate))
+    self.write_queue.put(None)
+
+  def write_worker(self):
+    while True:
+      snapshot = self.write_queue.get()
+      if snapshot is None:
+        break
+      iteration, vel, rho, cstate = snapshot
+      try:
+        self.vis.update_vel_rho(iteration, vel, rho)
+        self.saver.save(iteration, vel, rho, cstate)
+      except Exception as e:
+        self.error = e
@@ -0,0 +1,77 @@
+
+import threading
+import numpy as np
+
+class PrioritySampler:
+  # samples items with probability proportional to priority = loss^alpha.
+  # priorities are kept in a sum tree (leaves at capacity..2*capacity-1,
+  # node i is the sum of 2*i and 2*i+1) so sampling and updates are
+  # O(log capacity). Once full the lowest priority item is evicted, every
+  # leaf has a generation that changes when its item is replaced so late
+  # updates for an evicted item are dropped.
+
+  def __init__(self, capacity, alpha=0.6, eps=1e-6):
+    self.capacity = capacity
+    self.alpha = alpha
+    self.eps = eps
+    self.tree = np.zeros(2*capacity, dtype=np.float64)
+    self.items = capacity*[None]
+    self.generations = np.zeros(capacity, dtype=np.int64)
+    self.num_items = 0
+    self.max_priority = 1.0
+    self.lock = threading.Lock()
+
+  def add(self, item):
+    with self.lock:
+      if self.num_items < self.capacity:
+        leaf = self.num_items
+        self.num_items += 1
+      else:
+        # evict easiest item
+        leaf = int(np.argmin(self.tree[self.capacity:]))
+      self.items[leaf] = item
+      self.generations[leaf] += 1
+      # new items get the max priority so they are seen at least once
+      self.set_priority(leaf, self.max_priority)
+      return leaf
+
+  def sample(self):
+    with self.lock:
+      while True:
+        r = np.random.uniform(0.0, self.tree[1])
+        node = 1
+        while node < self.capacity:
+          node = 2*node
+          if r >= self.tree[node]:
+            r -= self.tree[node]
+            node += 1
+        leaf = node - self.capacity
+        # rounding can land on an empty leaf, just draw again
+        if self.tree[node] > 0.0:
+          return leaf, self.generations[leaf], self.items[leaf]
+
+  def update(self, leaves, generations, losses):
+    # returns the (item, loss) pairs that were applied
+    updated = []
+    with self.lock:
+      for leaf, generation, loss in zip(leaves, generations, losses):
+        if self.generations[leaf] != generation:
+          continue
+        priority = pow(abs(float(loss)) + self.eps, self.alpha)
+        self.max_priority = max(self.max_priority, priority)
+        self.set_priority(leaf, priority)
+        updated.append((self.items[leaf], loss))
+    return updated
+
+  def set_priority(self, leaf, priority):
+    node = leaf + self.capacity
+    self.tree[node] = priority
+    node = node/2
+    while node >= 1:
+      self.tree[node] = self.tree[2*node] + self.tree[2*node+1]
+      node = node/2
+
+  def stored_items(self):
+    with self.lock:
+      return self.items[:self.num_items]
+
@@ -3,6 +3,9 @@ import os
 import psutil as ps
 import glob
 import sys
+import threading
+import json
+import hashlib
 from copy import copy
 
 import lattice
@@ -30,17 +33,28 @@ class SailfishSimulation:
     self.train_sim_dir = config.train_sim_dir
     self.train_autoencoder = config.train_autoencoder
     self.config=config
+    self.use_state_store = config.use_state_store
+    self.gen_device = config.gen_gpus.split(',')[0]
  
     self.sim_shape = domain.sim_shape
     self.DxQy = lattice.TYPES[config.DxQy]()
 
     self.domain = domain(config)
 
-    self.padding_type = ['zero', 'zero']
+    self.padding_type = self.DxQy.dims * ['zero']
     if self.domain.periodic_x:
       self.padding_type[0] = 'periodic'
     if self.domain.periodic_y:
       self.padding_type[1] = 'periodic'
+    if self.DxQy.dims == 3 and self.domain.periodic_z:
+      self.padding_type[2] = 'periodic'
+
+    # memory mapped state store (opened with open_state_store)
+    self.state_store = None
+    self.state_store_ind = {}
+
+    # index of saved cpoints (loaded with update_index)
+    self.index = None
 
   def create_sailfish_simulation(self):
 
@@ -93,7 +107,7 @@ class SailfishSimulation:
           })
         if len(shape) == 3:
           defaults.update({
-            'grid': 'D3Q15',
+            'grid': self.config.DxQy,
             'periodic_z': periodic_z,
             'lat_nz': shape[2]
           })
@@ -119,13 +133,71 @@ class SailfishSimulation:
     return ctrl
 
   def list_cpoints(self):
-    cpoints = glob.glob(self.save_dir + "/*.0.cpoint.npz")
-    cpoints.sort()
-    return cpoints
+    if self.index is None:
+      self.update_index()
+    return [self.save_dir + '/' + x for x in self.index['cpoints']]
+
+  def num_saved_cpoints(self):
+    if self.index is None:
+      self.update_index()
+    return len(self.index['cpoints'])
+
+  def geometry_hash(self):
+    if self.index is None:
+      self.update_index()
+    return self.index['geometry_hash']
+
+  def index_file(self):
+    # kept next to the sim dir so writing it does not change the dir mtime
+    return self.save_dir + "_index.json"
+
+  def update_index(self):
+    # the index is only rebuilt if the sim dir changed since it was saved, 
+    # shapes and geometry hash are only recomputed for new files
+    index = self.index
+    if index is None and os.path.isfile(self.index_file()):
+      with open(self.index_file(), 'r') as f:
+        index = json.load(f)
+    if index is None:
+      index = {'dir_mtime': None, 'cpoints': [], 'state_shape': None, 
+               'geometry_mtime': None, 'geometry_hash': None}
+    if not os.path.isdir(self.save_dir):
+      self.index = index
+      return
+    dir_mtime = os.path.getmtime(self.save_dir)
+    if index['dir_mtime'] != dir_mtime:
+      cpoints = [os.path.basename(x) for x in glob.glob(self.save_dir + "/*.0.cpoint.npz")]
+      cpoints.sort()
+      if len(cpoints) == 0 or cpoints[:1] != index['cpoints'][:1]:
+        index['state_shape'] = None
+      if index['state_shape'] is None and len(cpoints) > 0:
+        index['state_shape'] = list(self.cpoint_to_state(self.save_dir + '/' + cpoints[0]).shape)
+      index['cpoints'] = cpoints
+      if os.path.isfile(self.boundary_file()):
+        geometry_mtime = os.path.getmtime(self.boundary_file())
+        if index['geometry_mtime'] != geometry_mtime:
+          with open(self.boundary_file(), 'rb') as f:
+            index['geometry_hash'] = hashlib.sha1(f.read()).hexdigest()
+          index['geometry_mtime'] = geometry_mtime
+      else:
+        index['geometry_mtime'] = None
+        index['geometry_hash'] = None
+      index['dir_mtime'] = dir_mtime
+      with open(self.index_file() + '.tmp', 'w') as f:
+        json.dump(index, f)
+      os.rename(self.index_file() + '.tmp', self.index_file())
+    self.index = index
 
   def boundary_file(self):
     return self.save_dir + "/flow_geometry.npy"
 
+  def state_store_file(self):
+    # kept next to the sim dir so writing it does not change the dir mtime
+    return self.save_dir + "_state_store.npy"
+
+  def state_store_meta_file(self):
+    return self.save_dir + "_state_store.json"
+
   def first_cpoint(self):
     cpoints = self.list_cpoints()
     return cpoints[0], self.cpoint_to_iter(cpoints[0])
@@ -135,6 +207,7 @@ class SailfishSimulation:
     return cpoints[-1], self.cpoint_to_iter(cpoints[-1])
  
   def is_restorable(self):
+    self.update_index()
     cpoints = self.list_cpoints()
     boundary_file = self.boundary_file()
     return ((len(cpoints) > 0) and os.path.isfile(boundary_file))
@@ -177,6 +250,35 @@ class SailfishSimulation:
       p = ps.subprocess.Popen(["mv", f, self.save_dir + "/"])
       p.communicate()
 
+  def recover_store_dir(self):
+    # sailfish writes into store and files are only moved once it exits, 
+    # after a crash or kill the complete files left there are moved into 
+    # the sim dir and .tmp leftovers of interrupted writes removed. Other 
+    # files that can not be read may only be unavailable for now so they 
+    # are reported and nothing is moved
+    store_files = glob.glob(self.save_dir + "/store/*")
+    store_files.sort()
+    tmp_files = [f for f in store_files if f.endswith('.tmp')]
+    if len(tmp_files) > 0:
+      print("removing incomplete " + ', '.join(tmp_files))
+      self.rm_files(tmp_files)
+    store_files = [f for f in store_files if not f.endswith('.tmp')]
+    unreadable = []
+    for f in store_files:
+      try:
+        data = np.load(f)
+        if f.endswith('.npz'):
+          for key in data.files:
+            data[key]
+          data.close()
+      except Exception as e:
+        unreadable.append(f + " (" + str(e) + ")")
+    if len(unreadable) > 0:
+      raise IOError("can not read store files " + ', '.join(unreadable))
+    for f in store_files:
+      os.rename(f, self.save_dir + "/" + os.path.basename(f))
+    self.update_index()
+
   def rm_files(self, file_list):
     for f in file_list:
       with open(os.devnull, 'w') as devnull:
@@ -184,7 +286,7 @@ class SailfishSimulation:
                                  stdout=devnull, stderr=devnull)
         p.communicate()
  
-  def new_sim(self, num_iters):
+  def new_sim(self, num_iters, device=None):
 
     self.make_sim_dir()
     self.clean_dir()
@@ -202,13 +304,16 @@ class SailfishSimulation:
            + ' --mode=visualization'
            + ' --run_mode=generate_data')
     print(cmd)
+    if device is None:
+      device = self.gen_device
     p = ps.subprocess.Popen(cmd.split(' '), 
-                            env=dict(os.environ, CUDA_VISIBLE_DEVICES='1'))
+                            env=dict(os.environ, CUDA_VISIBLE_DEVICES=str(device)))
     p.communicate()
    
     self.mv_store_dir()
+    self.update_index()
  
-  def restart_sim(self, num_iters, keep_old=False):
+  def restart_sim(self, num_iters, keep_old=False, device=None):
 
     assert self.is_restorable(), "trying to restart sim without finding proper save"
     self.clean_store_dir()
@@ -228,13 +333,16 @@ class SailfishSimulation:
     else:
       cmd += ' --train_sim_dir=' + self.save_dir + '/store/flow'
     print(cmd)
+    if device is None:
+      device = self.gen_device
     p = ps.subprocess.Popen(cmd.split(' '), 
-                            env=dict(os.environ, CUDA_VISIBLE_DEVICES='1'))
+                            env=dict(os.environ, CUDA_VISIBLE_DEVICES=str(device)))
     p.communicate()
   
     if not keep_old:
       self.clean_dir()
     self.mv_store_dir()
+    self.update_index()
 
   def read_boundary(self, subdomain=None, add_batch=False):
     boundary_file = self.boundary_file()
@@ -242,7 +350,7 @@ class SailfishSimulation:
     if os.path.isfile(boundary_file):
       boundary = np.load(boundary_file)
       boundary = boundary.astype(np.float32)
-      boundary = boundary[1:-1,1:-1]
+      boundary = boundary[tuple(len(self.sim_shape)*[slice(1, -1)])]
       if subdomain is not None:
         boundary, pad_boundary = numpy_utils.mobius_extract(boundary, subdomain,
                                               padding_type=self.padding_type,
@@ -255,15 +363,70 @@ class SailfishSimulation:
     else:
       return boundary
 
-  def read_state(self, iteration, subdomain=None, add_batch=False):
-    # load flow file
-    state_file = self.iter_to_cpoint(iteration)
-    state = np.load(state_file)
-    state = state.f.dist0a[:,1:-1,1:self.sim_shape[1]+1]
+  def cpoint_to_state(self, cpoint):
+    # load flow file and convert to latnet layout
+    # dist0a is (Q, [Z,] Y, X) with a halo around every spatial dim
+    state = np.load(cpoint)
+    crop = tuple([slice(None)] + [slice(1, n+1) for n in self.sim_shape])
+    state = state.f.dist0a[crop]
     state = state.astype(np.float32)
-    state = np.swapaxes(state, 0, 1)
-    state = np.swapaxes(state, 1, 2)
+    state = np.moveaxis(state, 0, -1)
     state = self.DxQy.subtract_lattice(state)
+    return state
+
+  def state_store_sources(self, cpoints):
+    # name, size and mtime of every cpoint so rewritten ones are noticed
+    sources = []
+    for cpoint in cpoints:
+      stat = os.stat(cpoint)
+      sources.append([os.path.basename(cpoint), stat.st_size, stat.st_mtime])
+    return sources
+
+  def state_store_is_current(self, cpoints):
+    if not (os.path.isfile(self.state_store_file()) 
+            and os.path.isfile(self.state_store_meta_file())):
+      return False
+    with open(self.state_store_meta_file(), 'r') as f:
+      meta = json.load(f)
+    return meta['sources'] == self.state_store_sources(cpoints)
+
+  def make_state_store(self):
+    # one time conversion of all cpoints into a contiguous float32 
+    # (T, X, Y, Q) array so random subdomain reads only touch needed pages
+    cpoints = self.list_cpoints()
+    if not self.state_store_is_current(cpoints):
+      self.state_store = None
+      state = self.cpoint_to_state(cpoints[0])
+      tmp_file = self.state_store_file() + '.tmp'
+      store = np.lib.format.open_memmap(tmp_file, mode='w+', dtype=np.float32,
+                                        shape=(len(cpoints),) + state.shape)
+      for i in xrange(len(cpoints)):
+        store[i] = self.cpoint_to_state(cpoints[i])
+      store.flush()
+      del store
+      os.rename(tmp_file, self.state_store_file())
+      # meta written last so an interrupted write is never taken as current
+      meta = {'iters': [self.cpoint_to_iter(x) for x in cpoints],
+              'sources': self.state_store_sources(cpoints)}
+      with open(self.state_store_meta_file() + '.tmp', 'w') as f:
+        json.dump(meta, f)
+      os.rename(self.state_store_meta_file() + '.tmp', self.state_store_meta_file())
+    self.open_state_store()
+
+  def open_state_store(self):
+    self.state_store = np.load(self.state_store_file(), mmap_mode='r')
+    with open(self.state_store_meta_file(), 'r') as f:
+      store_iters = json.load(f)['iters']
+    self.state_store_ind = dict((int(x), i) for i, x in enumerate(store_iters))
+
+  def read_state(self, iteration, subdomain=None, add_batch=False):
+    # load flow from store if possible
+    if self.state_store is not None and iteration in self.state_store_ind:
+      state = self.state_store[self.state_store_ind[iteration]]
+      if subdomain is None:
+        state = np.array(state)
+    else:
+      state = self.cpoint_to_state(self.iter_to_cpoint(iteration))
     if subdomain is not None:
       state, pad_state = numpy_utils.mobius_extract(state, subdomain,
                                             padding_type=self.padding_type,
@@ -279,23 +442,33 @@ class SailfishSimulation:
 
   def read_vel_rho(self, iteration, subdomain=None, add_batch=False):
     state = self.read_state(iteration, subdomain, add_batch=add_batch)
-    vel = self.DxQy.lattice_to_vel(state)
-    rho = self.DxQy.lattice_to_rho(state)
-    return vel, rho
+    if subdomain is not None:
+      state = state[0]
+    moments = self.DxQy.lattice_to_moments(state)
+    return moments['vel'], moments['rho']
 
 class TrainSailfishSimulation(SailfishSimulation):
 
   def __init__(self, config, domain, save_dir):
     SailfishSimulation.__init__(self, config, domain, save_dir)
     self.num_cpoints = config.max_sim_iters
+    self.augment = config.augment
     # more configs will probably be added later
     self.data_points = []
 
-  def read_train_data(self, augment=False):
+    # boundary cache shared by data workers, (halo, boundary, pad_boundary)
+    self.boundary_cache = None
+    self.boundary_lock = threading.Lock()
+
+  def read_train_data(self, data_point=None, augment=None):
+
+    if augment is None:
+      augment = self.augment
 
     # select datapoint
-    point_ind = np.random.randint(0, len(self.data_points))
-    data_point = self.data_points[point_ind]
+    if data_point is None:
+      point_ind = np.random.randint(0, len(self.data_points))
+      data_point = self.data_points[point_ind]
 
     # read state
     state = self.read_state(data_point.ind, data_point.state_subdomain)
@@ -308,27 +481,61 @@ class TrainSailfishSimulation(SailfishSimulation):
     for i in xrange(data_point.seq_length):
       seq_state.append(self.read_state(data_point.ind + i, data_point.seq_state_subdomain))
 
-    # rotate data possibly
+    # rotate and flip data possibly
     if augment:
-      flip = np.random.randint(0,2)
-      if flip == 1:
-        state = self.DxQy.flip_lattice(state)
-        seq_state = [self.DxQy.flip_lattice(lat) for lat in seq_state]
-        boundary = np.flipud(boundary)
-        boundary = flip_boundary_vel(boundary)
-        boundary_small = np.flipud(boundary_small)
-        boundary_small = flip_boundary_vel(boundary_small)
-      rotate=np.random.randint(0,4)
-      if rotate > 0:
-        state = self.DxQy.rotate_lattice(state, rotate)
-        seq_state = [self.DxQy.rotate_lattice(lat, rotate) for lat in seq_state]
-        boundary = np.rot90(boundary, k=rotate, axes=(0,1))
-        boundary = rotate_boundary_vel(boundary, rotate)
-        boundary_small = np.rot90(boundary_small, k=rotate, axes=(0,1))
-        boundary_small = rotate_boundary_vel(boundary_small, rotate)
+      syms = self.DxQy.symmetries_for_shape(state[0].shape[:-1])
+      sym = syms[np.random.randint(0, len(syms))]
+      state = (self.DxQy.symmetry_lattice(state[0], sym),
+               self.DxQy.symmetry_field(state[1], sym))
+      seq_state = [(self.DxQy.symmetry_lattice(lat, sym), 
+                    self.DxQy.symmetry_field(pad_lat, sym)) for lat, pad_lat in seq_state]
+      boundary = (symmetry_boundary(self.DxQy, boundary[0], sym),
+                  self.DxQy.symmetry_field(boundary[1], sym))
 
     return state, boundary, seq_state
 
+  def read_boundary(self, subdomain=None, add_batch=False):
+    # geometry is static so it is loaded once and kept padded with a
+    # halo large enough that subdomain reads are pure slicing
+    if subdomain is None or not os.path.isfile(self.boundary_file()):
+      return SailfishSimulation.read_boundary(self, subdomain, add_batch)
+    cache = self.boundary_cache
+    if cache is None or not self.halo_covers(cache[0], subdomain, cache[1].shape):
+      cache = self.make_boundary_cache(subdomain)
+    halo, padded_boundary, padded_pad_boundary = cache
+    ind = tuple([slice(x + h, x + h + y) for x, y, h in zip(subdomain.pos, subdomain.size, halo)])
+    boundary     = padded_boundary[ind].copy()
+    pad_boundary = padded_pad_boundary[ind].copy()
+    if add_batch:
+      boundary     = np.expand_dims(boundary, axis=0)
+      pad_boundary = np.expand_dims(pad_boundary, axis=0)
+    return (boundary, pad_boundary)
+
+  def halo_covers(self, halo, subdomain, padded_shape):
+    for x, y, h, s in zip(subdomain.pos, subdomain.size, halo, padded_shape):
+      if (x + h < 0) or (x + h + y > s):
+        return False
+    return True
+
+  def make_boundary_cache(self, subdomain):
+    with self.boundary_lock:
+      cache = self.boundary_cache
+      if cache is not None and self.halo_covers(cache[0], subdomain, cache[1].shape):
+        return cache
+      boundary = SailfishSimulation.read_boundary(self)
+      halo = [0] * len(subdomain.pos)
+      if cache is not None:
+        halo = cache[0]
+      halo = [max(h, -x, x + y - n) for h, x, y, n in zip(halo, subdomain.pos, 
+                                                          subdomain.size, boundary.shape)]
+      padded_subdomain = SubDomain([-h for h in halo],
+                                   [n + 2*h for h, n in zip(halo, boundary.shape)])
+      padded_boundary, padded_pad_boundary = numpy_utils.mobius_extract(boundary, padded_subdomain,
+                                                        padding_type=self.padding_type,
+                                                        return_padding=True)
+      self.boundary_cache = (halo, padded_boundary, padded_pad_boundary)
+      return self.boundary_cache
+
   def data_point_to_data(self, data_point, add_batch=False):
     # read state
     state = self.read_state(data_point.ind, data_point.state_subdomain, add_batch)
@@ -343,23 +550,30 @@ class TrainSailfishSimulation(SailfishSimulation):
 
     return state, boundary, seq_state
 
-  def generate_train_data(self):
-    self.new_sim(self.num_cpoints)
+  def generate_train_data(self, device=None):
+    self.boundary_cache = None
+    # resume partially generated sims from their last cpoint, including
+    # cpoints of an interrupted run still in the store dir
+    if os.path.isdir(self.save_dir + "/store"):
+      self.recover_store_dir()
+    num_saved = self.num_saved_cpoints() if self.is_restorable() else 0
+    if num_saved > 1 and num_saved < self.num_cpoints:
+      self.restart_sim(self.num_cpoints - num_saved, keep_old=True, device=device)
+    else:
+      self.new_sim(self.num_cpoints, device=device)
 
   def need_to_generate(self):
     # check if need to generate train data or not
     need = False
+    self.update_index()
     cpoints = self.list_cpoints()
-    if len(cpoints) != self.num_cpoints:
+    if len(cpoints) < self.num_cpoints:
       need = True 
     boundary_file = self.boundary_file()
     if not os.path.isfile(boundary_file):
       need = True 
     return need 
 
-  def add_data_point(self, data_point):
-    self.data_points.append(data_point)
-
   def make_rand_data_points(self, num_points, seq_length, state_shape_converter, seq_state_shape_converter, input_cshape, cratio):
     for i in xrange(num_points):
       # make datapoint and add to list
@@ -367,12 +581,11 @@ class TrainSailfishSimulation(SailfishSimulation):
 
   def rand_data_point(self, seq_length, state_shape_converter, seq_state_shape_converter, input_cshape, cratio):
     # select random index
-    state_files = glob.glob(self.save_dir + "/*.0.cpoint.npz")
-    ind = np.random.randint(1, len(state_files) - seq_length)
+    ind = np.random.randint(1, self.num_saved_cpoints() - seq_length)
 
     # select random pos to grab from data
-    rand_pos = [np.random.randint(-input_cshape[0], self.sim_shape[0]/cratio+1),
-                np.random.randint(-input_cshape[1], self.sim_shape[1]/cratio+1)]
+    rand_pos = [np.random.randint(-input_cshape[i], self.sim_shape[i]/cratio+1)
+                for i in xrange(len(input_cshape))]
     #rand_pos = [np.random.randint(-1, self.sim_shape[0]/cratio-input_cshape[0]),
     #            np.random.randint(-1, self.sim_shape[1]/cratio-input_cshape[1])]
     cstate_subdomain = SubDomain(rand_pos, input_cshape)
@@ -397,14 +610,13 @@ class DataPoint:
     self.state_subdomain = state_subdomain
     self.seq_state_subdomain = seq_state_subdomain
 
-def flip_boundary_vel(boundary):
-  boundary[...,1] = -boundary[...,1]
+def symmetry_boundary(DxQy, boundary, sym):
+  # boundary is geometry, velocity, density and force so the velocity and 
+  # force components also change with the symmetry
+  dims = DxQy.dims
+  boundary = DxQy.symmetry_field(boundary, sym)
+  boundary = np.concatenate([boundary[...,:1],
+                             DxQy.symmetry_components(boundary[...,1:1+dims], sym),
+                             boundary[...,1+dims:2+dims],
+                             DxQy.symmetry_components(boundary[...,2+dims:], sym)], axis=-1)
   return boundary
-
-def rotate_boundary_vel(boundary, k):
-  for i in xrange(k):
-    store_boundary = boundary[...,0]
-    boundary[...,0] = -boundary[...,1]
-    boundary[...,1] = boundary[...,0]
-  return boundary
-
@@ -1,22 +1,48 @@
 
 import lattice
+import utils.numpy_utils as numpy_utils
+from utils.vtk_utils import write_vti, read_vti, write_pvd, vtk_vector_order
 
 import numpy as np
 import psutil as ps
 import os
 import glob
+import json
+import zlib
+import itertools
+from collections import OrderedDict
 
 class SimSaver:
 
-  def __init__(self, config):
+  # number of decoded reads kept when saving compressed state
+  decode_cache_size = 8
+
+  def __init__(self, config, new_run=True):
     self.save_dir = config.sim_dir
     self.save_format = config.save_format
     self.save_cstate = config.save_cstate
+    # cstate is on the compressed grid so it can not go in the vti image
+    if self.save_format == 'vtk' and self.save_cstate and not config.save_compressed:
+      raise ValueError("save_cstate is not supported with the vtk save format")
     self.DxQy = lattice.TYPES[config.DxQy]
     self.sim_restore_iter = config.sim_restore_iter
     self.lb_to_ln = config.lb_to_ln
 
     self.latnet_files = []
+    self.vtk_series = []
+    self.save_chunk = config.save_chunk
+
+    # only save compressed state and decode it when read
+    self.save_compressed = config.save_compressed
+    self.decoder = None
+    self.cboundary = None
+    self.decode_cache = OrderedDict()
+
+    # single chunked file for whole run, a new run replaces the old one
+    if self.save_format == 'chunked':
+      self.run_store = ChunkedRun(self.save_dir + '/latnet_run', 
+                                  config.save_chunk, config.save_precision,
+                                  new_run=new_run)
 
   def iter_to_filename(self, iteration, with_format=False):
     file_name = self.save_dir + '/' + str(iteration).zfill(6) + ".cpoint"
@@ -30,29 +56,110 @@ class SimSaver:
     if self.save_format == 'npy':
       self.save_numpy(iteration, vel, rho, cstate)
     elif self.save_format == 'vtk':
-      # TODO add vtk save method
-      print("vtk save formate not implemented yet")
-      exit()
+      self.save_vtk(iteration, vel, rho, cstate)
+    elif self.save_format == 'chunked':
+      self.save_chunked(iteration, vel, rho, cstate)
 
   def save_numpy(self, iteration, vel, rho, cstate):
     file_name = self.iter_to_filename(iteration)
-    if self.save_cstate:
+    if self.save_compressed:
+      np.savez(file_name, cstate=cstate[0])
+    elif self.save_cstate:
       np.savez(file_name, vel=vel[0], rho=rho[0], cstate=cstate[0])
     else:
       np.savez(file_name, vel=vel[0], rho=rho[0])
     self.latnet_files.append(file_name)
 
-  def read_vel_rho(self, iteration, subdomain=None, add_batch=False):
+  def save_vtk(self, iteration, vel, rho, cstate):
+    # compressed state is not a vtk field, it is kept in an npz instead
+    if self.save_compressed:
+      self.save_numpy(iteration, vel, rho, cstate)
+      return
+    file_name = self.iter_to_filename(iteration, with_format=True)
+    write_vti(file_name, [('vel', vel[0]), ('rho', rho[0])], self.save_chunk,
+              vector_order=vtk_vector_order(self.DxQy.c_axes))
+    self.latnet_files.append(file_name)
+    # time series index for paraview
+    self.vtk_series.append((iteration, file_name))
+    write_pvd(self.save_dir + '/latnet_run.pvd', self.vtk_series)
+
+  def save_chunked(self, iteration, vel, rho, cstate):
+    if self.save_compressed:
+      fields = {'cstate': cstate[0]}
+    else:
+      fields = {'vel': vel[0], 'rho': rho[0]}
+      if self.save_cstate:
+        fields['cstate'] = cstate[0]
+    self.run_store.append(iteration, fields, native=['cstate'])
+
+  def cboundary_filename(self):
+    return self.save_dir + '/cboundary.npy'
+
+  def save_cboundary(self, cboundary):
+    np.save(self.cboundary_filename(), cboundary[0])
+    self.cboundary = cboundary
+
+  def read_cstate(self, iteration):
     if self.save_format == 'npy':
+      _, _, cstate = self.load_numpy(iteration)
+    elif self.save_format == 'vtk':
+      save_file = np.load(self.iter_to_filename(iteration) + '.npz')
+      cstate = save_file.f.cstate
+    elif self.save_format == 'chunked':
+      cstate = self.run_store.read('cstate', iteration)
+    return cstate
+
+  def decode_vel_rho(self, iteration, subdomain=None):
+    # decoded reads are cached with the most recent last
+    key = (iteration,)
+    if subdomain is not None:
+      key += (tuple(subdomain.pos), tuple(subdomain.size))
+    if key in self.decode_cache:
+      vel_rho = self.decode_cache.pop(key)
+    else:
+      if self.cboundary is None:
+        self.cboundary = np.expand_dims(np.load(self.cboundary_filename()), axis=0)
+      cstate = np.expand_dims(self.read_cstate(iteration), axis=0)
+      vel, rho = self.decoder(cstate, self.cboundary, subdomain)
+      vel_rho = (vel[0], rho[0])
+    self.decode_cache[key] = vel_rho
+    if len(self.decode_cache) > self.decode_cache_size:
+      self.decode_cache.popitem(last=False)
+    return vel_rho
+
+  def read_vel_rho(self, iteration, subdomain=None, add_batch=False):
+    if self.save_compressed:
+      vel, rho = self.decode_vel_rho(iteration, subdomain)
+    elif self.save_format == 'npy':
       vel, rho, _ = self.load_numpy(iteration)
+      vel, rho = self.extract_vel_rho(vel, rho, subdomain)
+    elif self.save_format == 'vtk':
+      file_name = self.iter_to_filename(iteration, with_format=True)
+      vel = read_vti(file_name, 'vel', components=self.DxQy.dims, 
+                     vector_order=vtk_vector_order(self.DxQy.c_axes))
+      rho = read_vti(file_name, 'rho')
+      vel, rho = self.extract_vel_rho(vel, rho, subdomain)
+    elif self.save_format == 'chunked':
+      vel = self.run_store.read('vel', iteration, subdomain)
+      rho = self.run_store.read('rho', iteration, subdomain)
     if add_batch:
       vel = np.expand_dims(vel, axis=0)
       rho = np.expand_dims(rho, axis=0)
     return vel, rho
 
+  def extract_vel_rho(self, vel, rho, subdomain):
+    # window wraps around the domain like chunked reads
+    if subdomain is not None:
+      padding_type = len(subdomain.size)*['periodic']
+      vel = numpy_utils.mobius_extract(vel, subdomain, padding_type=padding_type)
+      rho = numpy_utils.mobius_extract(rho, subdomain, padding_type=padding_type)
+    return vel, rho
+
   def load_numpy(self, iteration):
     file_name = self.iter_to_filename(iteration, with_format=True)
     save_file = np.load(file_name)
+    if self.save_compressed:
+      return None, None, save_file.f.cstate
     vel = save_file.f.vel
     rho = save_file.f.rho
     if self.save_cstate:
@@ -61,6 +168,112 @@ class SimSaver:
       cstate = None
     return vel, rho, cstate
 
-    
+class ChunkedRun:
+  # appendable file holding every saved iteration of a run. Each field is 
+  # split into spatial chunks that are compressed and appended to the data
+  # file. One json line per iteration is appended to the index file giving 
+  # the offset of every chunk so single chunks can be read back.
+
+  def __init__(self, path, chunk_size, precision='float32', new_run=False):
+    self.data_file = path + '.dat'
+    self.index_file = path + '.idx'
+    self.chunk_size = chunk_size
+    self.precision = precision
+    self.index = {}
+
+    # a new run starts from empty files, otherwise saves are appended
+    if new_run:
+      for f in [self.data_file, self.index_file]:
+        if os.path.isfile(f):
+          os.remove(f)
+
+  def append(self, iteration, fields, native=[]):
+    records = {}
+    with open(self.data_file, 'ab') as f:
+      f.seek(0, 2)
+      for name, dat in fields.items():
+        precision = 'float32' if name in native else self.precision
+        chunks = []
+        for pos in self.chunk_positions(dat.shape[:-1]):
+          block = dat[tuple([slice(p, p + self.chunk_size) for p in pos])]
+          block, lo, scale = encode_chunk(block, precision)
+          buf = zlib.compress(block.tobytes(), 1)
+          chunks.append([list(pos), f.tell(), len(buf), list(block.shape), 
+                         block.dtype.str, lo, scale])
+          f.write(buf)
+        records[name] = {'shape': list(dat.shape), 'chunks': chunks}
+    # index written after data so a partial save is never referenced
+    with open(self.index_file, 'a') as f:
+      f.write(json.dumps({'iteration': iteration, 'fields': records}) + '\n')
+    self.index[iteration] = records
+
+  def chunk_positions(self, shape):
+    return itertools.product(*[xrange(0, n, self.chunk_size) for n in shape])
+
+  def load_index(self):
+    self.index = {}
+    if os.path.isfile(self.index_file):
+      with open(self.index_file, 'r') as f:
+        for line in f:
+          record = json.loads(line)
+          self.index[record['iteration']] = record['fields']
+
+  def iterations(self):
+    self.load_index()
+    return sorted(self.index.keys())
+
+  def read(self, name, iteration, subdomain=None):
+    if iteration not in self.index:
+      self.load_index()
+    record = self.index[iteration][name]
+    shape = record['shape']
+    spatial_shape = shape[:-1]
+    c = self.chunk_size
+
+    # global indices to read on each axis, wrapped around the domain
+    if subdomain is None:
+      inds = [np.arange(n) for n in spatial_shape]
+    else:
+      inds = [np.mod(np.arange(p, p + s), n) for p, s, n 
+              in zip(subdomain.pos, subdomain.size, spatial_shape)]
+    chunk_ids = [np.unique(ind / c) for ind in inds]
+
+    # read needed chunks into compact array
+    compact = np.zeros([len(ids)*c for ids in chunk_ids] + [shape[-1]], 
+                       dtype=np.float32)
+    with open(self.data_file, 'rb') as f:
+      for pos, offset, length, chunk_shape, dtype, lo, scale in record['chunks']:
+        ranks = [np.searchsorted(ids, p / c) for ids, p in zip(chunk_ids, pos)]
+        if not all([r < len(ids) and ids[r] == p / c for r, ids, p 
+                    in zip(ranks, chunk_ids, pos)]):
+          continue
+        f.seek(offset)
+        block = np.frombuffer(zlib.decompress(f.read(length)), dtype=np.dtype(dtype))
+        block = decode_chunk(block.reshape(chunk_shape), lo, scale)
+        compact[tuple([slice(r*c, r*c + n) for r, n 
+                       in zip(ranks, chunk_shape[:-1])])] = block
+
+    # gather window from compact array
+    local = [np.searchsorted(ids, ind / c)*c + np.mod(ind, c) 
+             for ids, ind in zip(chunk_ids, inds)]
+    return compact[np.ix_(*(local + [np.arange(shape[-1])]))]
 
+def encode_chunk(block, precision):
+  # returns encoded block and the offset and scale needed to decode it
+  if precision == 'float32':
+    return block.astype(np.float32), 0.0, 1.0
+  elif precision == 'float16':
+    return block.astype(np.float16), 0.0, 1.0
+  elif precision in ['quant8', 'quant16']:
+    bits = int(precision[5:])
+    lo = float(np.min(block))
+    scale = (float(np.max(block)) - lo) / (2**bits - 1)
+    if scale == 0.0:
+      scale = 1.0
+    block = np.round((block - lo) / scale).astype('uint' + str(bits))
+    return block, lo, scale
+  else:
+    raise ValueError("unknown save precision " + precision)
 
+def decode_chunk(block, lo, scale):
+  return block.astype(np.float32) * scale + lo
@@ -0,0 +1,58 @@
+
+import threading
+import Queue
+
+class SimScheduler:
+  # runs sailfish data generation for many simulations at once. Each 
+  # device in gen_gpus gets gen_jobs_per_gpu worker threads, every worker 
+  # runs one sailfish process at a time on its device. Failed simulations 
+  # are retried and on_ready is called as soon as a simulation is done,
+  # on_done is called after every job whether it worked or not
+
+  def __init__(self, config):
+    self.devices = config.gen_gpus.split(',')
+    self.jobs_per_device = config.gen_jobs_per_gpu
+    self.max_retries = config.gen_retries
+    self.jobs = Queue.Queue()
+    self.failed = []
+    self.workers = []
+
+  def add(self, sim, on_ready, on_done=None):
+    self.jobs.put((sim, on_ready, on_done))
+
+  def start(self):
+    for device in self.devices:
+      for i in xrange(self.jobs_per_device):
+        thr = threading.Thread(target=self.worker, args=(device,))
+        thr.daemon = True
+        thr.start()
+        self.workers.append(thr)
+
+  def wait(self):
+    self.jobs.join()
+
+  def worker(self, device):
+    while True:
+      sim, on_ready, on_done = self.jobs.get()
+      # task_done always runs so waiting on unfinished_tasks never hangs
+      try:
+        for attempt in xrange(self.max_retries + 1):
+          try:
+            sim.generate_train_data(device)
+          except Exception as e:
+            print("generating " + sim.save_dir + " failed with " + str(e))
+          if not sim.need_to_generate():
+            break
+          if attempt < self.max_retries:
+            print("retrying " + sim.save_dir)
+        if sim.need_to_generate():
+          self.failed.append(sim)
+        else:
+          on_ready(sim)
+      except Exception as e:
+        print("adding " + sim.save_dir + " failed with " + str(e))
+        self.failed.append(sim)
+      finally:
+        self.jobs.task_done()
+        if on_done is not None:
+          on_done()
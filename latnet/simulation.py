@@ -13,6 +13,8 @@ from utils.python_utils import *
 from shape_converter import SubDomain
 from vis import Visualizations
 from sim_saver import SimSaver
+from cboundary_cache import CBoundaryCache
+from output_stage import OutputStage
 from sailfish_simulation import SailfishSimulation
 import lattice
 
@@ -54,6 +56,12 @@ class Simulation(object):
     self.sim_save_every = config.sim_save_every
     self.sim_restore_iter = config.sim_restore_iter
     self.compare = config.compare
+    self.eval_batch_size = config.eval_batch_size
+    self.eval_memory = config.eval_memory
+    self.eval_memory_factor = config.eval_memory_factor
+    self.full_domain = config.full_domain
+    self.resident_state = config.resident_state
+    self.output_backlog = config.output_backlog
     self.domain.script_name = self.script_name
 
     # run time holders
@@ -69,12 +77,17 @@ class Simulation(object):
     # make saver
     self.saver = SimSaver(self.config)
 
+    # make cache of encoded boundaries
+    self.cboundary_cache = CBoundaryCache(self.config)
+
     # set padding 
-    self.padding_type = ['zero', 'zero']
+    self.padding_type = self.DxQy.dims * ['zero']
     if self.domain.periodic_x:
       self.padding_type[0] = 'periodic'
     if self.domain.periodic_y:
       self.padding_type[1] = 'periodic'
+    if self.DxQy.dims == 3 and self.domain.periodic_z:
+      self.padding_type[2] = 'periodic'
 
   def run(self):
 
@@ -82,7 +95,7 @@ class Simulation(object):
     self._network = self.network(self.config)
     (state_encoder, boundary_encoder, cmapping, cmapping_first, decoder_vel_rho,
       decoder_state, encoder_shape_converter, cmapping_shape_converter, 
-      decoder_shape_converter) = self._network.eval_unroll()
+      decoder_shape_converter, cmapping_full, cmapping_first_full) = self._network.eval_unroll(self.padding_type)
 
     # possibly generate start state and boundary (really just used for testing)
     if self.sim_restore_iter > 0:
@@ -103,9 +116,53 @@ class Simulation(object):
 
     print("finised makeing compressed state and boundary")
 
+    # saver decodes compressed state when read back
+    def decode(cstate, cboundary, subdomain):
+      return self.cstate_to_vel_rho(decoder_vel_rho, 
+                                    decoder_shape_converter, 
+                                    cstate, cboundary, subdomain)
+    self.saver.decoder = decode
+    if self.saver.save_compressed:
+      self.saver.save_cboundary(cboundary)
+
+    # possibly run compression mapping on the whole domain at once, falls
+    # back to tiles if it does not fit in memory
+    full_domain = self.full_domain
+    if full_domain and not self.fits_in_memory([cstate, cboundary]):
+      print("whole domain does not fit in eval memory, falling back to tiled compression mapping")
+      full_domain = False
+
+    # possibly keep compressed state on device between save points
+    resident = full_domain and self.resident_state
+
+    # decode, vis and save in background
+    if self.output_backlog > 0:
+      def decode(cstate, cboundary):
+        return self.cstate_to_vel_rho(decoder_vel_rho, 
+                                      decoder_shape_converter, 
+                                      cstate, cboundary)
+      output_stage = OutputStage(decode, self.vis, self.saver, self.output_backlog)
+    else:
+      output_stage = None
+
     # run simulation
-    for i in xrange(self.num_iters):
-      if i == 0:
+    i = 0
+    while i < self.num_iters:
+      if resident and i > 0:
+        # step on device up to the next save point
+        num_steps = min(self.num_iters, self.sim_save_every*((i/self.sim_save_every)+1)) - i
+        self._network.step_resident_cstate(num_steps)
+        i += num_steps - 1
+        if (i+1) % self.sim_save_every == 0:
+          cstate = self._network.read_resident_cstate()
+      elif full_domain and i == 0:
+        cstate = cmapping_first_full(cstate, cboundary)
+        num_steps = 1
+        if resident:
+          self._network.load_resident_cstate(cstate, cboundary)
+      elif full_domain:
+        cstate = cmapping_full(cstate, cboundary)
+      elif i == 0:
         cstate = self.cstate_to_cstate(cmapping_first, 
                                        cmapping_shape_converter, 
                                        cstate, cboundary)
@@ -114,13 +171,19 @@ class Simulation(object):
                                        cmapping_shape_converter, 
                                        cstate, cboundary)
 
-      if (i) % self.print_stats_every == 0:
+      if resident:
+        # print time states every call
+        self.update_time_stats(num_steps)
+        self.print_stats(self.time_stats, i)
+      elif (i) % self.print_stats_every == 0:
         # print time states
         self.update_time_stats()
         self.print_stats(self.time_stats, i)
 
 
-      if (i+1) % self.sim_save_every == 0:
+      if (i+1) % self.sim_save_every == 0 and output_stage is not None:
+        output_stage.put(i, cstate, cboundary)
+      elif (i+1) % self.sim_save_every == 0:
         # decode state
         vel, rho = self.cstate_to_vel_rho(decoder_vel_rho, 
                                           decoder_shape_converter, 
@@ -131,6 +194,11 @@ class Simulation(object):
         self.vis.update_vel_rho(i, vel, rho)
         self.saver.save(i, vel, rho, cstate)
 
+      i += 1
+
+    # wait for remaining saves
+    if output_stage is not None:
+      output_stage.close()
 
     # generate comparision simulation
     if self.compare:
@@ -140,12 +208,14 @@ class Simulation(object):
         self.sailfish_runner = SailfishSimulation(self.config, self.domain, self.sim_dir + '/sailfish')
         self.sailfish_runner.new_sim(self.num_iters)
 
-      # run comparision function
+      # run comparision function, only the visualized part is read
+      vis_subdomain = self.vis.vis_subdomain()
       for i in xrange(self.num_iters):
         if i % self.sim_save_every == 0:
           # this functionality will probably be changed TODO
-          true_vel, true_rho = self.sailfish_runner.read_vel_rho(i + self.sim_restore_iter + 1, add_batch=True)
-          generated_vel, generated_rho = self.saver.read_vel_rho(i, add_batch=True)
+          true_vel, true_rho = self.sailfish_runner.read_vel_rho(i + self.sim_restore_iter + 1, 
+                                                                 subdomain=vis_subdomain, add_batch=True)
+          generated_vel, generated_rho = self.saver.read_vel_rho(i, subdomain=vis_subdomain, add_batch=True)
           self.vis.update_compare_vel_rho(i, true_vel, true_rho, generated_vel, generated_rho)
 
   def input_boundary(self, input_subdomain):
@@ -161,11 +231,12 @@ class Simulation(object):
 
   def mapping(self, mapping, shape_converter, input_generator, output_shape, run_output_shape):
     nr_subdomains = [int(math.ceil(x/float(y))) for x, y in zip(output_shape, run_output_shape)]
-    output = []
-    for ijk in itertools.product(xrange(nr_subdomains[0]), xrange(nr_subdomains[1])):
-      # make input and output subdomains
-      if not(type(shape_converter) is list):
-        shape_converter = [shape_converter]
+    if not(type(shape_converter) is list):
+      shape_converter = [shape_converter]
+
+    # make input subdomains for every tile, output subdomain is the same for all
+    tiles_input_subdomain = []
+    for ijk in itertools.product(*[xrange(n) for n in nr_subdomains]):
       input_subdomain = []
       output_subdomain = []
       for converter in shape_converter:
@@ -175,23 +246,34 @@ class Simulation(object):
         output_subdomain.append(converter.in_out_subdomain(copy(input_subdomain[-1])))
       output_subdomain = output_subdomain[0]
       output_subdomain.zero_pos()
+      tiles_input_subdomain.append(input_subdomain)
 
+    # run tiles in batches, tiles are all the same size so their inputs 
+    # can be concatenated along the batch dim
+    output = []
+    first_input = input_generator(*tiles_input_subdomain[0])
+    batch_size = self.tile_batch_size(first_input, len(tiles_input_subdomain))
+    for start in xrange(0, len(tiles_input_subdomain), batch_size):
       # generate input with input generator
-      sub_input = input_generator(*input_subdomain)
+      tiles_input = [input_generator(*x) for x in tiles_input_subdomain[max(start, 1):start+batch_size]]
+      if start == 0:
+        tiles_input = [first_input] + tiles_input
+      for i in xrange(len(tiles_input)):
+        if not (type(tiles_input[i]) is list):
+          tiles_input[i] = [tiles_input[i]]
+      sub_input = [concat_batch([x[k] for x in tiles_input]) for k in xrange(len(tiles_input[0]))]
 
       # perform mapping function and extract out if needed
-      if not (type(sub_input) is list):
-        sub_input = [sub_input]
       sub_output = mapping(*sub_input)
       if not (type(sub_output) is list):
         sub_output = [sub_output]
-
       for i in xrange(len(sub_output)):
         sub_output[i] = numpy_utils.mobius_extract(sub_output[i], output_subdomain, 
                                                    has_batch=True)
 
       # append to list of sub outputs
-      output.append(sub_output)
+      for k in xrange(len(tiles_input)):
+        output.append([x[k:k+1] for x in sub_output])
 
     # make total output shape
     total_subdomain = SubDomain(len(output_shape)*[0], output_shape)
@@ -209,6 +291,23 @@ class Simulation(object):
       output = output[0]
     return output
 
+  def memory_budget(self):
+    # tiles run on the device so only eval_memory is used
+    return 1e6 * self.eval_memory
+
+  def network_memory(self, net_input):
+    # estimate device memory of a network call from its input, activations
+    # are assumed to be at most eval_memory_factor times larger
+    return self.eval_memory_factor * sum([x.nbytes for x in flatten_tuples(net_input)])
+
+  def fits_in_memory(self, net_input):
+    return self.network_memory(net_input) <= self.memory_budget()
+
+  def tile_batch_size(self, tile_input, num_tiles):
+    if self.eval_batch_size > 0:
+      return min(self.eval_batch_size, num_tiles)
+    return int(max(1, min(num_tiles, self.memory_budget() / self.network_memory(tile_input))))
+
   def state_to_cstate(self, encoder, encoder_shape_converter):
 
     def input_generator(subdomain):
@@ -234,6 +333,16 @@ class Simulation(object):
 
   def boundary_to_cboundary(self, encoder, encoder_shape_converter):
 
+    # encoded boundary can be reused if the geometry and network are the same
+    key = None
+    checkpoint = self._network.saver.latest_checkpoint()
+    if (self.cboundary_cache.enabled() and (self.start_boundary is not None)
+        and (checkpoint is not None)):
+      key = self.cboundary_cache.key(self.start_boundary, checkpoint, self.padding_type)
+      cboundary = self.cboundary_cache.load(key)
+      if cboundary is not None:
+        return cboundary
+
     def input_generator(subdomain):
       if self.start_boundary is not None:
         input_geometry, pad_input_geometry = numpy_utils.mobius_extract(self.start_boundary, 
@@ -251,6 +360,8 @@ class Simulation(object):
     cboundary = self.mapping(encoder, encoder_shape_converter, 
                             input_generator, self.sim_cshape, 
                             self.input_cshape)
+    if key is not None:
+      self.cboundary_cache.save(key, cboundary)
     return cboundary
 
   def cstate_to_cstate(self, cmapping, cmapping_shape_converter, cstate, cboundary):
@@ -292,9 +403,22 @@ class Simulation(object):
                               self.input_shape)
     return state
 
-  def cstate_to_vel_rho(self, decoder, decoder_shape_converter, cstate, cboundary):
+  def cstate_to_vel_rho(self, decoder, decoder_shape_converter, cstate, cboundary, subdomain=None):
+
+    # only decode tiles covering subdomain, decoded region starts on a 
+    # compressed cell so it is possibly larger then subdomain
+    if subdomain is None:
+      subdomain = SubDomain(len(self.sim_shape)*[0], self.sim_shape)
+    factor = self.input_shape[0] / self.input_cshape[0]
+    cpos = [x / factor for x in subdomain.pos]
+    offset = [x - y * factor for x, y in zip(subdomain.pos, cpos)]
+    decode_shape = [x + y for x, y in zip(subdomain.size, offset)]
 
     def input_generator(cstate_subdomain, cboundary_subdomain):
+      cstate_subdomain = SubDomain([x + y for x, y in zip(cstate_subdomain.pos, cpos)], 
+                                   cstate_subdomain.size)
+      cboundary_subdomain = SubDomain([x + y for x, y in zip(cboundary_subdomain.pos, cpos)], 
+                                      cboundary_subdomain.size)
       sub_cstate    = numpy_utils.mobius_extract(cstate,    cstate_subdomain,    
                                                  has_batch=True, 
                                                  padding_type=self.padding_type,
@@ -306,20 +430,26 @@ class Simulation(object):
       return [sub_cstate, sub_cboundary]
 
     [vel, rho] = self.mapping(decoder, [decoder_shape_converter, decoder_shape_converter], 
-                              input_generator, self.sim_shape, 
+                              input_generator, decode_shape, 
                               self.input_shape)
+    if decode_shape != subdomain.size:
+      vel = numpy_utils.mobius_extract(vel, SubDomain(offset, subdomain.size), has_batch=True)
+      rho = numpy_utils.mobius_extract(rho, SubDomain(offset, subdomain.size), has_batch=True)
     return vel, rho
 
-  def update_time_stats(self):
+  def update_time_stats(self, steps=None):
+    # number of steps since last update
+    if steps is None:
+      steps = self.print_stats_every
     # stop timer
     self.toc = time.time()
     # update total run time
     self.time_stats['run_time'] = int(time.time() - self.start_time)
     # update total step time
-    self.time_stats['MLOPS'] = (self.config.lb_to_ln*self.print_stats_every*float(np.prod(np.array(self.sim_shape))) / 
+    self.time_stats['MLOPS'] = (self.config.lb_to_ln*steps*float(np.prod(np.array(self.sim_shape))) / 
                                (1000000*(self.toc - self.tic)))
     # time per step
-    self.time_stats['time_per_step'] = (self.toc - self.tic)/self.print_stats_every
+    self.time_stats['time_per_step'] = (self.toc - self.tic)/steps
     # start timer
     self.tic = time.time()
 
@@ -331,3 +461,14 @@ class Simulation(object):
     print("EVAL INFO - step " + str(step))
     print(print_string)
 
+def flatten_tuples(dat):
+  # list of arrays in a (possibly nested) list or tuple of arrays
+  if type(dat) in [list, tuple]:
+    return [y for x in dat for y in flatten_tuples(x)]
+  return [dat]
+
+def concat_batch(dat):
+  # concatenates a list of tile inputs along the batch dim keeping (state, pad) tuples
+  if type(dat[0]) is tuple:
+    return tuple([concat_batch([x[i] for x in dat]) for i in xrange(len(dat[0]))])
+  return np.concatenate(dat, axis=0)
@@ -54,29 +54,62 @@ class Trainer(object):
       domain.script_name = self.script_name
     self.data_queue = DataQueue(self.config, self.domains, self._network.train_shape_converter())
 
+  def init_session(self):
+    # started after the data queue so its processes are not forked from a
+    # running tf session
+    self._network.train_session()
+
   def train(self):
  
     # steps per print (hard set for now untill done debugging)
     steps_per_print = 20
 
+    # with input staging the first batch is staged before the first step
+    # and every step stages the next batch while training on the last one
+    if self.config.input_staging:
+      self._network.run('stage_op', feed_dict=self.data_queue.minibatch(), staged=True)
+      staged_ids = self.data_queue.batch_ids
+
+    # global step is read once, after that every train step returns it
+    step = int(self._network.run('gen_global_step'))
+
     while True: 
       # get batch of data
       feed_dict = self.data_queue.minibatch()
       feed_dict['phase'] = 1
 
-      # perform optimization step for gen
-      gen_names = ['gen_train_op', 'loss_gen']
+      # sampler ids of the batch being trained on
+      train_ids = self.data_queue.batch_ids
+      if self.config.input_staging:
+        train_ids, staged_ids = staged_ids, train_ids
+
+      # perform optimization step for gen, and for disc every k steps either
+      # in the same session call or in a second one
+      disc_step = self.gan and (step % self.config.gan_disc_every == 0)
+      disc_names = ['disc_train_op', 'loss_disc', 'loss_disc_un_class', 'loss_disc_con_class']
+      gen_names = ['gen_train_op', 'loss_gen', 'loss_gen_sample']
       if not self.gan:
         if self.train_autoencoder:
           gen_names += ['loss_auto_l2']
         gen_names += ['loss_comp_l2']
       if self.gan:
         gen_names += ['loss_l1', 'loss_gen_un_class', 'loss_layer_l2', 'loss_gen_con_class']
-      gen_output = self._network.run(gen_names, feed_dict=feed_dict, return_dict=True)
-      if self.gan:
-        disc_names = ['disc_train_op', 'loss_disc', 'loss_disc_un_class', 'loss_disc_con_class']
+      if disc_step and self._network.gan_fused:
+        gen_names += disc_names
+      if self.config.input_staging:
+        gen_names += ['stage_op']
+      # summaries are fetched with the train step when they are due
+      summary = (step + 1) % steps_per_print == 0
+      gen_output = self._network.train_step(gen_names, feed_dict, 
+                                            staged=self.config.input_staging,
+                                            summary=summary)
+      step = gen_output['gen_global_step']
+      if disc_step and not self._network.gan_fused:
         disc_output = self._network.run(disc_names, feed_dict=feed_dict, return_dict=True)
         gen_output.update(disc_output)
+
+      # update sampling priorities with the per sample loss of this step
+      self.data_queue.update_priorities(train_ids, gen_output['loss_gen_sample'])
          
       # update loss summary
       self.update_loss_stats(gen_output)
@@ -85,49 +118,24 @@ class Trainer(object):
       self.update_time_stats()
 
       # print required data and save
-      step = self._network.run('gen_global_step')
       if step % steps_per_print == 0:
         self.print_stats(self.loss_stats, self.time_stats, self.data_queue.queue_stats(), step)
-        # TODO integrat this into self.saver
-        tf_feed_dict = {}
-        for name in feed_dict.keys():
-          if type(feed_dict[name]) is tuple:
-            tf_feed_dict[self._network.in_tensors[name]] = feed_dict[name][0]
-            tf_feed_dict[self._network.in_pad_tensors[name]] = feed_dict[name][1]
-          else:
-            tf_feed_dict[self._network.in_tensors[name]] = feed_dict[name]
-        ###
-        self._network.saver.save_summary(self._network.sess, tf_feed_dict, int(self._network.run('gen_global_step')))
 
       if step % self.config.save_network_freq == 0:
-        self._network.saver.save_checkpoint(self._network.sess, int(self._network.run('gen_global_step')))
+        self._network.saver.save_checkpoint(self._network.sess, step)
 
       if step % 400 == 0:
-        print("getting new data")
-        self.active_data_add()
+        self.data_queue.add_rand_data_points(40)
 
       # end simulation
       if step > self.train_iters:
         break
 
-  def active_data_add(self):
-    # TODO this should be cleaned up
-    loss_data_point_pair = []
-    for i in tqdm(xrange(200)):
-      sim_index, data_point, feed_dict = self.data_queue.rand_data_point()
-      loss_names = ['loss_gen']
-      loss_output = self._network.run(loss_names, feed_dict=feed_dict, return_dict=True)
-      loss_data_point_pair.append((loss_output['loss_gen'], sim_index, data_point))
-
-    loss_data_point_pair.sort() 
-    for i in xrange(40):
-      self.data_queue.add_data_point(loss_data_point_pair[-i][1], loss_data_point_pair[-i][2])
-
   def update_loss_stats(self, output):
     names = output.keys()
     names.sort()
     for name in names:
-      if 'loss' in name:
+      if 'loss' in name and not name.endswith('_sample'):
         # update loss history
         if name + '_history' not in self.loss_stats.keys():
           self.loss_stats[name + '_history'] = []
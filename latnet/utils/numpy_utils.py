@@ -1,68 +1,71 @@
 
 
 import numpy as np
+import itertools
 import matplotlib.pyplot as plt
 
 def mobius_extract(dat, subdomain, padding_type=['periodic', 'periodic'], has_batch=False, return_padding=False):
-  # extracts a chunk at pos and with size from a dat tensor 
-  shape = dat.shape
-  if has_batch:
-    shape = shape[1:]
-
-  # padding tensor
-  padding_tensor = np.ones_like(dat[...,0:1])
+  # extracts a chunk at pos and with size from a dat tensor. Only the
+  # requested window is copied, wrapped or zero filled regions are worked
+  # out per axis so the full field is never padded.
+  batch_dims = 1 if has_batch else 0
+  spatial_shape = dat.shape[batch_dims:batch_dims + len(subdomain.size)]
 
-  # pad x
-  pad_bottom_x = abs(min(subdomain.pos[0], 0))
-  pad_top_x = max((subdomain.pos[0] + subdomain.size[0]) - shape[0], 0)
-  padding_x = [[pad_bottom_x, pad_top_x], [0,0], [0,0]]
-  if has_batch:
-    padding_x = [[0,0]] + padding_x
-  if padding_type[0] == 'periodic':
-    dat = np.pad(dat, padding_x, 'wrap')
-    padding_tensor = np.pad(padding_tensor, padding_x, 'wrap')
-  elif padding_type[0] == 'zero':
-    dat = np.pad(dat, padding_x, 'constant')
-    padding_tensor = np.pad(padding_tensor, padding_x, 'constant')
-  new_pos_x = subdomain.pos[0] + pad_bottom_x
-  dat = dat[..., new_pos_x:new_pos_x + subdomain.size[0], :, :]
-  padding_tensor = padding_tensor[..., new_pos_x:new_pos_x + subdomain.size[0], :, :]
-  
+  # runs of (src_start, src_stop, dst_start) along each spatial axis
+  runs = []
+  for i in xrange(len(subdomain.size)):
+    runs.append(_axis_runs(subdomain.pos[i], subdomain.size[i],
+                           spatial_shape[i], padding_type[i]))
 
-  # pad y
-  pad_bottom_y = abs(min(subdomain.pos[1], 0))
-  pad_top_y = max((subdomain.pos[1] + subdomain.size[1]) - shape[1], 0)
-  padding_y = [[0,0], [pad_bottom_y, pad_top_y], [0,0]]
-  if has_batch:
-    padding_y = [[0,0]] + padding_y
-  if padding_type[1] == 'periodic':
-    dat = np.pad(dat, padding_y, 'wrap')
-    padding_tensor = np.pad(padding_tensor, padding_y, 'wrap')
-  elif padding_type[1] == 'zero':
-    dat = np.pad(dat, padding_y, 'constant')
-    padding_tensor = np.pad(padding_tensor, padding_y, 'constant')
-  new_pos_y = subdomain.pos[1] + pad_bottom_y
-  dat = dat[..., new_pos_y:new_pos_y + subdomain.size[1], :]
-  padding_tensor = padding_tensor[..., new_pos_y:new_pos_y + subdomain.size[1], :]
+  # output tensors
+  out_shape = dat.shape[:batch_dims] + tuple(subdomain.size) + dat.shape[-1:]
+  out = np.zeros(out_shape, dtype=dat.dtype)
+  if return_padding:
+    padding_tensor = np.ones(out_shape[:-1] + (1,), dtype=np.result_type(1.0, dat.dtype))
 
-  padding_tensor = (1.0 - padding_tensor)
+  # copy valid blocks
+  lead = batch_dims * [slice(None)]
+  for block in itertools.product(*runs):
+    src = tuple(lead + [slice(r[0], r[1]) for r in block])
+    dst = tuple(lead + [slice(r[2], r[2] + r[1] - r[0]) for r in block])
+    out[dst] = dat[src]
+    if return_padding:
+      padding_tensor[dst] = 0.0
 
   if return_padding:
-    return dat, padding_tensor
+    return out, padding_tensor
   else:
-    return dat
+    return out
+
+def _axis_runs(pos, size, length, padding_type):
+  # contiguous source runs that make up [pos, pos+size) along one axis
+  runs = []
+  if padding_type == 'periodic':
+    dst = 0
+    while dst < size:
+      src = (pos + dst) % length
+      run = min(length - src, size - dst)
+      runs.append((src, src + run, dst))
+      dst += run
+  else:
+    src_start = max(pos, 0)
+    src_stop = min(pos + size, length)
+    if src_stop > src_start:
+      runs.append((src_start, src_stop, src_start - pos))
+  return runs
 
 def stack_grid(dat, shape, has_batch=False):
   if has_batch:
-    axis=2
-  else:
     axis=1
-  # converts a list of numpy arrays to a single array acording to shape
-  dat = [dat[i:i+shape[1]] for i in range(0, len(dat), shape[1])]
-  for i in xrange(shape[0]):
-    dat[i] = np.concatenate(dat[i], axis=axis) 
-  dat = np.concatenate(dat, axis=axis-1)
-  return dat
+  else:
+    axis=0
+  # converts a list of numpy arrays in row major order to a single array 
+  # acording to shape, the last grid axis is joined first
+  dat = list(dat)
+  for i in reversed(xrange(len(shape))):
+    dat = [np.concatenate(dat[j:j+shape[i]], axis=axis+i) 
+           for j in xrange(0, len(dat), shape[i])]
+  return dat[0]
 
 """
 # short test
@@ -0,0 +1,108 @@
+
+import numpy as np
+import os
+import re
+
+# minimal writer and reader for VTK image data (.vti) files with the
+# arrays stored as appended raw binary, no vtk library needed
+
+def vtk_extent(spatial_shape):
+  # arrays are indexed [z,] y, x so the extent is reversed
+  extent = []
+  for n in reversed(spatial_shape):
+    extent += [0, n-1]
+  extent += (6 - len(extent)) * [0]
+  return ' '.join(map(str, extent))
+
+def vtk_vector_order(c_axes):
+  # vector component c_axes[k] moves along array axis k and vtk takes the
+  # last array axis as x so the components are reversed to get (x,y,z)
+  return [x for x in reversed(c_axes)]
+
+def vtk_components(dat):
+  # vectors in 2D are padded to 3 components so paraview can show them
+  components = dat.shape[-1]
+  if components == 2:
+    components = 3
+  return components
+
+def write_vti(file_name, fields, rows_per_write=256, vector_order=None):
+  # fields is a list of (name, array) with arrays shaped [z,] y, x, c,
+  # components of vector fields are put in (x,y,z) order with vector_order
+  spatial_shape = fields[0][1].shape[:-1]
+  extent = vtk_extent(spatial_shape)
+  num_points = int(np.prod(spatial_shape))
+
+  # header, offsets are known from the array sizes
+  header = ['<?xml version="1.0"?>',
+            '<VTKFile type="ImageData" version="1.0" byte_order="LittleEndian" header_type="UInt64">',
+            '  <ImageData WholeExtent="' + extent + '" Origin="0 0 0" Spacing="1 1 1">',
+            '    <Piece Extent="' + extent + '">',
+            '      <PointData>']
+  offset = 0
+  for name, dat in fields:
+    components = vtk_components(dat)
+    header.append('        <DataArray type="Float32" Name="' + name 
+                + '" NumberOfComponents="' + str(components) 
+                + '" format="appended" offset="' + str(offset) + '"/>')
+    offset += 8 + 4 * components * num_points
+  header += ['      </PointData>',
+             '    </Piece>',
+             '  </ImageData>',
+             '  <AppendedData encoding="raw">']
+
+  # stream arrays a block of rows at a time
+  with open(file_name + '.tmp', 'wb') as f:
+    f.write('\n'.join(header) + '\n_')
+    for name, dat in fields:
+      components = vtk_components(dat)
+      np.array([4 * components * num_points], dtype='<u8').tofile(f)
+      for start in xrange(0, dat.shape[0], rows_per_write):
+        block = np.asarray(dat[start:start+rows_per_write], dtype='<f4')
+        if vector_order is not None and block.shape[-1] > 1:
+          block = block[..., vector_order]
+        if components != block.shape[-1]:
+          pad = np.zeros(block.shape[:-1] + (components - block.shape[-1],), dtype='<f4')
+          block = np.concatenate([block, pad], axis=-1)
+        block.tofile(f)
+    f.write('\n  </AppendedData>\n</VTKFile>\n')
+  os.rename(file_name + '.tmp', file_name)
+
+def read_vti(file_name, name, components=None, vector_order=None):
+  # reads an array written by write_vti, vector_order undoes the reorder
+  # of the vector components
+  with open(file_name, 'rb') as f:
+    dat = f.read()
+  data_start = dat.index('<AppendedData encoding="raw">')
+  data_start = dat.index('_', data_start) + 1
+  header = dat[:data_start]
+  extent = map(int, re.search('WholeExtent="([^"]*)"', header).group(1).split())
+  spatial_shape = [extent[i+1] - extent[i] + 1 for i in xrange(0, 6, 2)]
+  spatial_shape = [n for n in reversed(spatial_shape)]
+  if spatial_shape[0] == 1:
+    spatial_shape = spatial_shape[1:]
+  array = re.search('<DataArray[^>]*Name="' + name + '"[^>]*/>', header).group(0)
+  num_components = int(re.search('NumberOfComponents="([0-9]*)"', array).group(1))
+  offset = int(re.search('offset="([0-9]*)"', array).group(1))
+  size = int(np.frombuffer(dat, dtype='<u8', count=1, offset=data_start + offset)[0])
+  out = np.frombuffer(dat, dtype='<f4', count=size/4, offset=data_start + offset + 8)
+  out = out.reshape(spatial_shape + [num_components])
+  if components is not None:
+    out = out[..., :components]
+  if vector_order is not None and out.shape[-1] > 1:
+    out = out[..., np.argsort(vector_order)]
+  return out
+
+def write_pvd(file_name, entries):
+  # time series index, entries is a list of (time step, vti file name)
+  lines = ['<?xml version="1.0"?>',
+           '<VTKFile type="Collection" version="1.0" byte_order="LittleEndian">',
+           '  <Collection>']
+  for step, vti_file in entries:
+    lines.append('    <DataSet timestep="' + str(step) + '" part="0" file="' 
+                + os.path.basename(vti_file) + '"/>')
+  lines += ['  </Collection>',
+            '</VTKFile>']
+  with open(file_name + '.tmp', 'w') as f:
+    f.write('\n'.join(lines) + '\n')
+  os.rename(file_name + '.tmp', file_name)
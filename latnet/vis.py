@@ -8,6 +8,7 @@ import numpy as np
 import os
 import psutil as ps
 from utils.python_utils import *
+from shape_converter import SubDomain
 
 # this class will handle visualizaitions with pygame
 # for right now it will just use cv2 to make a video
@@ -38,6 +39,13 @@ class Visualizations:
     frame = self.feild_to_colormap(frame)
     self.compare_video.write(frame)
 
+  def vis_subdomain(self):
+    # frames of 3D fields only show the first slice along the last axis
+    size = list(self.sim_shape)
+    if len(size) == 3:
+      size[2] = 1
+    return SubDomain(len(size)*[0], size)
+
   def feild_to_colormap(self, feild):
     feild = feild - np.min(feild)
     feild = np.uint8(255 * feild/np.max(feild))
@@ -45,6 +53,6 @@ class Visualizations:
     return feild
 
   def vel_rho_to_frame(self, vel, rho):
-    vel = np.sqrt(np.square(vel[0,:,:,0]) + np.square(vel[0,:,:,1]))
+    vel = self.DxQy.vel_to_norm(vel)[0,:,:,0]
     rho = rho[0,:,:,0]
     return np.concatenate([vel, rho], axis=0)